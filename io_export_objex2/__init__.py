@@ -54,6 +54,7 @@ from bpy.props import (
         IntProperty,
         FloatProperty,
         StringProperty,
+        EnumProperty,
         )
 from bpy_extras.io_utils import (
         ExportHelper,
@@ -62,6 +63,10 @@ from bpy_extras.io_utils import (
         )
 
 import os
+import time
+import io
+import cProfile
+import pstats
 try:
     import progress_report
 except ImportError:
@@ -71,11 +76,12 @@ except ImportError:
 import importlib
 loc = locals()
 for n in (
-    'export_objex', 'export_objex_mtl', 'export_objex_anim',
+    'export_objex', 'export_objex_mtl', 'export_objex_anim', 'export_objex_mesh', 'export_objex_cache',
     'properties', 'interface', 'const_data', 'util', 'logging_util',
     'rigging_helpers', 'data_updater', 'view3d_copybuffer_patch',
     'addon_updater', 'addon_updater_ops', 'blender_version_compatibility',
-    'node_setup_helpers',
+    'node_setup_helpers', 'output_sink', 'tracing', 'export_objex_stats',
+    'objex_binary', 'export_objex_binary', 'export_objex_index', 'format_pool',
 ):
     if n in loc:
         importlib.reload(loc[n])
@@ -237,6 +243,107 @@ class OBJEX_OT_export_base():
             default=export_objex.ObjexWriter.default_options['KEEP_VERTEX_ORDER'],
             )
 
+    format_processes = IntProperty(
+            name='Formatting Processes',
+            description=(
+                'Amount of worker processes formatting the objects text in parallel,\n'
+                'while Blender keeps reading the next objects.\n'
+                '0 formats everything in Blender itself.\n'
+                'Worker processes take a moment to start, which only pays off for large exports'
+            ),
+            default=export_objex.ObjexWriter.default_options['FORMAT_PROCESSES'],
+            min=0, soft_max=16,
+            )
+    use_object_cache = BoolProperty(
+            name='Cache Objects',
+            description=(
+                'Keep the vertex data of each object in a <file name>_objex_cache directory next to the exported file,\n'
+                'and reuse it when exporting again objects that did not change.\n'
+                'Entries of objects not in the last export are removed, the directory can be deleted at any time'
+            ),
+            default=export_objex.ObjexWriter.default_options['OBJECT_CACHE'],
+            )
+    low_memory = BoolProperty(
+            name='Low Memory',
+            description=(
+                'Write each object as soon as it is read and formatted, keeping as little data in memory as possible\n'
+                '(no formatting processes, instanced meshes are only reused for the instances of one object).\n'
+                'The memory usage after each step (extracting, building, formatting and writing each object,\n'
+                'materials, skeletons and animations) and its change are logged, and on Linux the peak during the step'
+            ),
+            default=export_objex.ObjexWriter.default_options['LOW_MEMORY'],
+            )
+    background_write = BoolProperty(
+            name='Write Files in Background',
+            description='Write files to disk from another thread, while the export goes on',
+            default=export_objex.ObjexWriter.default_options['BACKGROUND_WRITE'],
+            )
+    binary_container = EnumProperty(
+            items=[
+                ('NONE','None','Only write the text .objex',0),
+                ('ALONGSIDE','Alongside .objex','Write a binary container in addition to the text .objex',1),
+                ('INSTEAD','Instead of .objex','Write a binary container and no text .objex',2),
+            ],
+            name='Binary Container',
+            description=(
+                'Write the geometry, material names, skeletons and animations\n'
+                'to a .objexbin binary container, which can be read without parsing (see objex_binary.py).\n'
+                'Materials, skeletons and animations are still written to .mtlex, .skel and .anim'
+            ),
+            default=export_objex.ObjexWriter.default_options['BINARY_CONTAINER'],
+            )
+    compression = EnumProperty(
+            items=[
+                ('NONE','None','Write uncompressed text files',0),
+                ('GZIP','gzip','Compress text files with gzip (.gz)',1),
+                ('XZ','xz','Compress text files with xz (.xz), smaller but slower than gzip',2),
+            ],
+            name='Compression',
+            description=(
+                'Compress the .objex, .mtlex, .skel and .anim files as they are written,\n'
+                'adding the compression extension to their names (including in mtllib/skellib/animlib)'
+            ),
+            default=export_objex.ObjexWriter.default_options['COMPRESSION'],
+            )
+    atomic_write = BoolProperty(
+            name='Only Replace Changed Files',
+            description=(
+                'Write files to temporary files first, and only replace the existing files once the export succeeded\n'
+                'and if their content changed (unchanged files keep their modification time)'
+            ),
+            default=export_objex.ObjexWriter.default_options['ATOMIC_WRITE'],
+            )
+    export_id = EnumProperty(
+            items=[
+                ('TIME','Export Time','Use the time of the export as exportid',0),
+                ('CONTENT','Content Digest','Use a digest of the exported content as exportid',1),
+            ],
+            name='Export ID',
+            description=(
+                'The exportid written to the .objex, .mtlex, .skel and .anim files.\n'
+                'A digest of the content makes exporting unchanged data give identical files'
+            ),
+            default=export_objex.ObjexWriter.default_options['EXPORT_ID'],
+            )
+    use_index = BoolProperty(
+            name='Write Record Index',
+            description=(
+                'Write a _index.json file with the byte offset and length of each g, newmtl, newtex, newskel\n'
+                'and newanim record in the exported files (and the v/vt/vn/vc index base of groups),\n'
+                'for tools to read a record without parsing whole files'
+            ),
+            default=export_objex.ObjexWriter.default_options['INDEX'],
+            )
+    non_blocking = BoolProperty(
+            name='Non-Blocking Export',
+            description=(
+                'Export a few objects or animation frames at a time, keeping the interface responsive\n'
+                'and showing the progress. Press Esc to cancel the export.\n'
+                'The scene should not be edited until the export is done'
+            ),
+            default=False,
+            )
+
     global_scale = FloatProperty(
             name='Scale',
             soft_min=0.01, soft_max=1000.0,
@@ -280,6 +387,40 @@ class OBJEX_OT_export_base():
             ),
             default='objex_export_log.txt',
             )
+    profile_enable = BoolProperty(
+            name='Profile',
+            description=(
+                'Run the export under cProfile, write the statistics to a .pstats file\n'
+                'and log the functions taking the most time (cumulative).\n'
+                'Only the main thread is profiled'
+            ),
+            default=False,
+            )
+    profile_file_path = StringProperty(
+            name='Profile file path',
+            description=(
+                'The file to write profiling statistics to (see the pstats module).\n'
+                'Path can be relative (to export location) or absolute.'
+            ),
+            default='objex_export_profile.pstats',
+            )
+    use_trace = BoolProperty(
+            name='Write trace',
+            description=(
+                'Record how long each export step takes (per object, material, animation frame...)\n'
+                'to a <export name>_trace.json file, which can be opened in chrome://tracing or ui.perfetto.dev'
+            ),
+            default=export_objex.ObjexWriter.default_options['TRACE'],
+            )
+    use_stats = BoolProperty(
+            name='Write statistics',
+            description=(
+                'Write statistics of the export to a <export name>_stats.json file\n'
+                '(per object: vertex/face counts and deduplicated vt/vn/vc, per action: frame/bone counts,\n'
+                'per file: bytes per directive) and log a summary'
+            ),
+            default=export_objex.ObjexWriter.default_options['STATS'],
+            )
 
     path_mode = path_reference_mode
 
@@ -345,12 +486,27 @@ class OBJEX_OT_export_base():
             box.prop(self, 'export_packed_images_dir')
         else:
             self.layout.prop(self, 'export_packed_images')
+        self.layout.prop(self, 'format_processes')
+        self.layout.prop(self, 'use_object_cache')
+        self.layout.prop(self, 'low_memory')
+        self.layout.prop(self, 'background_write')
+        self.layout.prop(self, 'binary_container')
+        self.layout.prop(self, 'compression')
+        self.layout.prop(self, 'atomic_write')
+        self.layout.prop(self, 'export_id')
+        self.layout.prop(self, 'use_index')
+        self.layout.prop(self, 'non_blocking')
         box = self.layout.box()
         box.prop(self, 'logging_level_console')
         box.prop(self, 'logging_level_report')
         box.prop(self, 'logging_file_enable')
         if self.logging_file_enable:
             box.prop(self, 'logging_file_path')
+        box.prop(self, 'profile_enable')
+        if self.profile_enable:
+            box.prop(self, 'profile_file_path')
+        box.prop(self, 'use_trace')
+        box.prop(self, 'use_stats')
         self.layout.prop(self, 'path_mode')
 
     def execute(self, context):
@@ -364,6 +520,9 @@ class OBJEX_OT_export_base():
                                             'logging_level_report',
                                             'logging_file_enable',
                                             'logging_file_path',
+                                            'profile_enable',
+                                            'profile_file_path',
+                                            'non_blocking',
                                             ))
 
         global_matrix = blender_version_compatibility.matmul(
@@ -379,13 +538,13 @@ class OBJEX_OT_export_base():
             del keywords['use_collection']
 
         log = logging_util.getLogger('OBJEX_OT_export')
+        # with non_blocking, logging settings are reset by finish_non_blocking instead
+        running_modal = False
+        self._profiler = cProfile.Profile() if self.profile_enable else None
         try:
             logging_util.setConsoleLevel(self.logging_level_console)
             if self.logging_file_enable:
-                logfile_path = self.logging_file_path
-                if not os.path.isabs(logfile_path):
-                    export_dir, _ = os.path.split(self.filepath)
-                    logfile_path = '%s/%s' % (export_dir, logfile_path)
+                logfile_path = self.get_path_from_export_dir(self.logging_file_path)
                 log.info('Writing logs to {}', logfile_path)
                 logging_util.setLogFile(logfile_path)
             logging_util.setLogOperator(self, self.logging_level_report)
@@ -461,7 +620,12 @@ class OBJEX_OT_export_base():
                                 if bpy.app.version < (2, 80, 0) else '',
                             display_device_ok)
 
-            return export_objex.save(context, **keywords)
+            if self.non_blocking:
+                self.start_non_blocking(context, keywords)
+                running_modal = True
+                return {'RUNNING_MODAL'}
+
+            return self.run_profiled(export_objex.save, context, **keywords)
         except util.ObjexExportAbort as abort:
             log.error('Export abort: {}', abort.reason)
             return {'CANCELLED'}
@@ -469,8 +633,119 @@ class OBJEX_OT_export_base():
             log.exception('Uncaught exception')
             raise
         finally:
-            progress_report.print = print
-            logging_util.resetLoggingSettings()
+            if not running_modal:
+                self.write_profile()
+                progress_report.print = print
+                logging_util.resetLoggingSettings()
+
+    def get_path_from_export_dir(self, path):
+        """Return path, relative to the export location if it isn't absolute"""
+        if not os.path.isabs(path):
+            export_dir, _ = os.path.split(self.filepath)
+            path = '%s/%s' % (export_dir, path)
+        return path
+
+    def run_profiled(self, function, *args, **kwargs):
+        """Call function, collecting profiling statistics with profile_enable"""
+        if self._profiler is None:
+            return function(*args, **kwargs)
+        self._profiler.enable()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self._profiler.disable()
+
+    def write_profile(self):
+        """With profile_enable, write the statistics collected by run_profiled and log a summary"""
+        if self._profiler is None:
+            return
+        log = logging_util.getLogger('OBJEX_OT_export')
+        profiler = self._profiler
+        self._profiler = None
+        try:
+            profile_path = self.get_path_from_export_dir(self.profile_file_path)
+            profiler.dump_stats(profile_path)
+            summary = io.StringIO()
+            stats = pstats.Stats(profiler, stream=summary)
+            stats.sort_stats('cumulative').print_stats(PROFILE_SUMMARY_COUNT)
+            log.info('Wrote profile to {}, top {:d} functions by cumulative time:\n{}',
+                profile_path, PROFILE_SUMMARY_COUNT, summary.getvalue())
+        except Exception:
+            # don't fail the export because of profiling
+            log.exception('Could not write profile')
+
+    def start_non_blocking(self, context, keywords):
+        """Start exporting from timer events, see modal"""
+        keywords = keywords.copy()
+        filepath = keywords.pop('filepath')
+        self._objex_writer = export_objex.create_writer(context, **keywords)
+        self._export_iter = self._objex_writer.write_iter(filepath, report_progress=False)
+        wm = context.window_manager
+        self._timer = wm.event_timer_add(NON_BLOCKING_TIMER_STEP, window=context.window)
+        wm.modal_handler_add(self)
+        wm.progress_begin(0, 100)
+
+    def finish_non_blocking(self, context, result):
+        try:
+            # does nothing if the export is finished, otherwise stops it and restores the scene state
+            self._export_iter.close()
+        finally:
+            del self._export_iter
+            del self._objex_writer
+            wm = context.window_manager
+            wm.event_timer_remove(self._timer)
+            del self._timer
+            wm.progress_end()
+            try:
+                self.write_profile()
+            finally:
+                progress_report.print = print
+                logging_util.resetLoggingSettings()
+        return result
+
+    def modal(self, context, event):
+        log = logging_util.getLogger('OBJEX_OT_export')
+        if event.type == 'ESC':
+            if self._objex_writer.options['ATOMIC_WRITE']:
+                log.warning('Export cancelled, existing files were left as they were')
+            else:
+                log.warning('Export cancelled, exported files are incomplete')
+            return self.finish_non_blocking(context, {'CANCELLED'})
+        if event.type != 'TIMER':
+            # let the view be navigated, but nothing else (the scene is being exported)
+            if event.type in NON_BLOCKING_PASS_THROUGH_EVENTS:
+                return {'PASS_THROUGH'}
+            return {'RUNNING_MODAL'}
+        # export for a bit, then let the interface be redrawn
+        deadline = time.perf_counter() + NON_BLOCKING_TIME_SLICE
+        def export_slice():
+            while time.perf_counter() < deadline:
+                next(self._export_iter)
+        try:
+            self.run_profiled(export_slice)
+        except StopIteration:
+            return self.finish_non_blocking(context, {'FINISHED'})
+        except util.ObjexExportAbort as abort:
+            log.error('Export abort: {}', abort.reason)
+            return self.finish_non_blocking(context, {'CANCELLED'})
+        except:
+            log.exception('Uncaught exception')
+            self.finish_non_blocking(context, {'CANCELLED'})
+            raise
+        context.window_manager.progress_update(100 * self._objex_writer.get_progress())
+        return {'RUNNING_MODAL'}
+
+# amount of functions listed in the log with profile_enable
+PROFILE_SUMMARY_COUNT = 30
+
+# seconds between two timer events, and spent exporting on each, when exporting with non_blocking
+NON_BLOCKING_TIMER_STEP = 0.01
+NON_BLOCKING_TIME_SLICE = 0.1
+# events passed through to the interface during a non_blocking export
+NON_BLOCKING_PASS_THROUGH_EVENTS = {
+    'MOUSEMOVE', 'INBETWEEN_MOUSEMOVE', 'MIDDLEMOUSE', 'WHEELUPMOUSE', 'WHEELDOWNMOUSE',
+    'TRACKPADPAN', 'TRACKPADZOOM',
+}
 
 axis_forward = '-Z'
 axis_up='Y'
@@ -17,11 +17,16 @@
 from . import blender_version_compatibility
 
 import os
+import sys
 import time
+import hashlib
+import functools
+import contextlib
 
 import bpy
 import mathutils
 import bpy_extras.io_utils
+import numpy as np
 
 try:
     from progress_report import ProgressReport, ProgressReportSubstep
@@ -30,6 +35,14 @@ except ImportError:
 
 from . import export_objex_mtl
 from . import export_objex_anim
+from . import export_objex_mesh
+from . import export_objex_cache
+from . import export_objex_stats
+from . import export_objex_binary
+from . import export_objex_index
+from . import format_pool
+from . import output_sink
+from . import tracing
 from . import util
 from .logging_util import getLogger
 
@@ -42,11 +55,34 @@ def mesh_triangulate(me):
     bm.to_mesh(me)
     bm.free()
 
-def roundVect3d(v, digits):
-    return round(v.x, digits), round(v.y, digits), round(v.z, digits)
-
-def roundVect2d(v, digits):
-    return round(v[0], digits), round(v[1], digits)
+class ExtractedMesh():
+    """
+    The data of an evaluated mesh read by ObjexWriter.extract_mesh, after the Blender mesh is freed.
+    Positions and normals are in object space, unless a transform was applied to the mesh when reading it.
+    uvs/vertex_colors (and loops_to_*) are the deduplicated loop_uvs/loop_colors,
+    computed when first needed and then kept for the other instances sharing this mesh.
+    """
+    def __init__(self):
+        self.rigged_to_armature = None
+        self.rig_is_exported = False
+        self.vertex_positions = None
+        self.loop_vertex_indices = None
+        self.use_smooth_groups = False
+        self.materials = None
+        self.polygon_material_indices = None
+        self.polygon_smooth = None
+        self.polygon_images = None
+        self.face_polygons = None
+        self.corner_loops = None
+        self.face_sizes = None
+        self.vertex_weights = None
+        self.loop_uvs = None
+        self.loop_normals = None
+        self.loop_colors = None
+        self.uvs = None
+        self.loops_to_uvs = None
+        self.vertex_colors = None
+        self.loops_to_vertex_colors = None
 
 class ObjexWriter():
     default_options = {
@@ -71,7 +107,22 @@ class ObjexWriter():
         'EXPORT_PACKED_IMAGES': False,
         'EXPORT_PACKED_IMAGES_DIR': '//objex_textures',
         'GLOBAL_MATRIX': None,
-        'PATH_MODE': 'AUTO'
+        'PATH_MODE': 'AUTO',
+        'OUTPUT_CHUNK_SIZE': output_sink.DEFAULT_CHUNK_SIZE,
+        'FORMAT_PROCESSES': 0,
+        'OBJECT_CACHE': False,
+        'LOW_MEMORY': False,
+        'BACKGROUND_WRITE': True,
+        'TRACE': False,
+        'STATS': False,
+        # 'NONE', 'ALONGSIDE' (the text .objex) or 'INSTEAD' (of the text .objex)
+        'BINARY_CONTAINER': 'NONE',
+        # 'NONE' or a key of output_sink.COMPRESSION_EXTENSIONS, for text files
+        'COMPRESSION': 'NONE',
+        'ATOMIC_WRITE': True,
+        # 'TIME' or 'CONTENT' (a digest of the exported content)
+        'EXPORT_ID': 'TIME',
+        'INDEX': False,
     }
     
     def __init__(self, context):
@@ -88,6 +139,87 @@ class ObjexWriter():
             if v is not None:
                 self.options[k] = v
     
+    def get_text_output_path(self, filepath):
+        """Return the path a text file meant to be at filepath is written to, with the extension of the compression"""
+        compression = self.options['COMPRESSION']
+        if compression == 'NONE':
+            return filepath
+        return filepath + output_sink.COMPRESSION_EXTENSIONS[compression]
+
+    def open_output(self, filepath, binary=False):
+        """
+        Open an output file, all exported files are written through the returned OutputSink
+        Text files are compressed according to options, filepath should come from get_text_output_path
+        With a content exportid, text files get their exportid line with write_export_id_line
+        """
+        compression = self.options['COMPRESSION']
+        content_export_id = self.options['EXPORT_ID'] == 'CONTENT'
+        sink = output_sink.OutputSink(filepath, binary=binary, chunk_size=self.options['OUTPUT_CHUNK_SIZE'],
+                                      background=self.background_writer,
+                                      compression=None if binary or compression == 'NONE' else compression,
+                                      atomic=self.options['ATOMIC_WRITE'],
+                                      patchable=content_export_id and not binary)
+        if self.stats and not binary:
+            sink.add_observer(self.stats.get_directive_counter(filepath))
+        if content_export_id:
+            hasher = hashlib.sha1()
+            sink.add_observer(hasher.update)
+            self.content_hashers.append(hasher)
+        self.outputs.append(sink)
+        return sink
+    
+    def write_export_id_line(self, sink):
+        """Write the exportid line to sink (an OutputSink), as a placeholder filled by finish_export_id with a content exportid"""
+        if self.options['EXPORT_ID'] == 'CONTENT':
+            sink.write_placeholder(self.export_id_line)
+        else:
+            sink.write(self.export_id_line)
+
+    def finish_export_id(self):
+        """
+        Compute the content exportid from everything written so far and fill the exportid placeholders with it
+        Text files must be closed, the binary container not (its table isn't written yet)
+        """
+        combined_hasher = hashlib.sha1()
+        for sink in self.outputs:
+            sink.sync()
+        for hasher in self.content_hashers:
+            combined_hasher.update(hasher.digest())
+        if self.binary_writer:
+            combined_hasher.update(self.binary_writer.get_table())
+        # same format as a time, so the exportid is read the same way
+        export_id = '%010d.%06d' % divmod(int.from_bytes(combined_hasher.digest()[:8], 'big') % 10**16, 10**6)
+        export_id_line = 'exportid %s\n' % export_id
+        self.export_id = export_id
+        if self.binary_writer and self.binary_writer.meta['header'] is not None:
+            self.binary_writer.meta['header'] = self.binary_writer.meta['header'].replace(self.export_id_line, export_id_line, 1)
+        for sink in self.outputs:
+            if sink.placeholders:
+                sink.fill_placeholders({self.export_id_line: export_id_line})
+        self.log.info('Content exportid: {}', export_id)
+
+    def create_format_pool(self):
+        """
+        Return a pool of FORMAT_PROCESSES worker processes to format objects with, or None to format them serially
+        Workers are spawned and only import the bpy-free modules formatting objects (see format_pool)
+        """
+        processes = self.options['FORMAT_PROCESSES']
+        if processes <= 0:
+            return None
+        if self.options['LOW_MEMORY']:
+            # blocks waiting to be formatted or written would be kept in memory
+            self.log.info('Formatting objects serially, in low memory mode')
+            return None
+        if sys.version_info < (3, 7): # < 2.80, no mp_context
+            self.log.info('Formatting objects serially, worker processes need Python 3.7+')
+            return None
+        if bpy.app.version < (2, 91, 0): # sys.executable is the Blender executable
+            python_executable = bpy.app.binary_path_python
+        else:
+            python_executable = None
+        self.log.debug('Formatting objects with {:d} worker processes', processes)
+        return format_pool.create_pool(processes, __package__, python_executable)
+    
     def write_header(self):
         fw = self.fw_objex
         
@@ -98,140 +230,183 @@ class ObjexWriter():
         fw('# io_export_objex2 v%d.%d.%d\n' % (two, major, minor))
         fw('version %d.%d\n' % (two, major))
 
-        self.export_id_line = 'exportid %f\n' % time.time()
-        fw(self.export_id_line)
+        if self.options['EXPORT_ID'] == 'CONTENT':
+            # fixed width placeholder, see finish_export_id
+            self.export_id = None
+            self.export_id_line = 'exportid 0000000000.000000\n'
+        else:
+            self.export_id = '%f' % time.time()
+            self.export_id_line = 'exportid %s\n' % self.export_id
+        if self.objex_output:
+            self.write_export_id_line(self.objex_output)
+        else:
+            fw(self.export_id_line)
 
         scene = self.context.scene
         fw('softinfo animation_framerate %g\n' % (scene.render.fps / scene.render.fps_base))
 
         # Tell the obj file what material/skeleton/animation file to use.
         if self.options['EXPORT_MTL']:
-            self.filepath_mtl = os.path.splitext(self.filepath)[0] + ".mtlex"
+            self.filepath_mtl = self.get_text_output_path(os.path.splitext(self.filepath)[0] + ".mtlex")
             # filepath can contain non utf8 chars, use repr
             fw('mtllib %s\n' % repr(os.path.basename(self.filepath_mtl))[1:-1])
         
         if self.options['EXPORT_SKEL']:
-            self.filepath_skel = os.path.splitext(self.filepath)[0] + ".skel"
+            self.filepath_skel = self.get_text_output_path(os.path.splitext(self.filepath)[0] + ".skel")
             fw('skellib %s\n' % repr(os.path.basename(self.filepath_skel))[1:-1])
             if self.options['EXPORT_ANIM']:
-                self.filepath_anim = os.path.splitext(self.filepath)[0] + ".anim"
+                self.filepath_anim = self.get_text_output_path(os.path.splitext(self.filepath)[0] + ".anim")
                 fw('animlib %s\n' % repr(os.path.basename(self.filepath_anim))[1:-1])
                 if self.options['EXPORT_LINK_ANIM_BIN']:
                     self.filepath_linkbase = os.path.splitext(self.filepath)[0] + '_'
     
-    def write_uvs(self, mesh, face_index_pairs):
-        fw = self.fw_objex
-        
-        uv_unique_count = 0
-        loops = mesh.loops
-        uv_layer = mesh.uv_layers.active.data[:]
-        
-        # in case removing some of these dont get defined.
-        uv = f_index = uv_index = uv_key = uv_val = uv_ls = None
-
-        uv_face_mapping = [None] * len(face_index_pairs)
-
-        uv_dict = {}
-        uv_get = uv_dict.get
-        for f, f_index in face_index_pairs:
-            uv_ls = uv_face_mapping[f_index] = []
-            for uv_index, l_index in enumerate(f.loop_indices):
-                uv = uv_layer[l_index].uv
-                # include the vertex index in the key so we don't share UV's between vertices,
-                # allowed by the OBJ spec but can cause issues for other importers, see: T47010.
-
-                # this works too, shared UV's for all verts
-                #~ uv_key = veckey2d(uv)
-                uv_key = loops[l_index].vertex_index, roundVect2d(uv, 6)
-
-                uv_val = uv_get(uv_key)
-                if uv_val is None:
-                    uv_val = uv_dict[uv_key] = uv_unique_count
-                    fw('vt %.6f %.6f\n' % uv[:])
-                    uv_unique_count += 1
-                uv_ls.append(uv_val)
+    def extract_uvs(self, loop_uvs, corner_loops, loop_vertex_indices):
+        """
+        loop_uvs is the uv of each loop
+        corner_loops is the array of loop indices in the order they are used by faces
+        Return (uvs, loops_to_uvs) where uvs are the unique UVs to write as vt directives
+        and loops_to_uvs maps a loop index to its (mesh-local, 0-based) vt index
+        """
+        corner_uvs = loop_uvs[corner_loops]
+        # include the vertex index in the key so we don't share UV's between vertices,
+        # allowed by the OBJ spec but can cause issues for other importers, see: T47010.
+        uv_keys = np.column_stack((
+            loop_vertex_indices[corner_loops],
+            export_objex_mesh.quantize(corner_uvs, 6),
+        ))
+        first, corner_uv_indices = export_objex_mesh.unique_rows(uv_keys)
+
+        loops_to_uvs = np.zeros(len(loop_uvs), dtype=np.int64)
+        loops_to_uvs[corner_loops] = corner_uv_indices
         
-        return uv_face_mapping, uv_unique_count
+        return corner_uvs[first], loops_to_uvs
     
-    def write_normals(self, mesh, face_index_pairs):
-        fw = self.fw_objex
-        
-        no_unique_count = 0
-        loops = mesh.loops
-        
-        no_key = no_val = None
-        normals_to_idx = {}
-        no_get = normals_to_idx.get
-        loops_to_normals = [0] * len(loops)
-        for f, f_index in face_index_pairs:
-            for l_idx in f.loop_indices:
-                no_key = roundVect3d(loops[l_idx].normal, 4)
-                no_val = no_get(no_key)
-                if no_val is None:
-                    no_val = normals_to_idx[no_key] = no_unique_count
-                    fw('vn %.4f %.4f %.4f\n' % no_key)
-                    no_unique_count += 1
-                loops_to_normals[l_idx] = no_val
-        return loops_to_normals, no_unique_count
+    def extract_normals(self, loop_normals, corner_loops, normal_matrix):
+        """
+        loop_normals is the (object space) normal of each loop
+        corner_loops is the array of loop indices in the order they are used by faces
+        normal_matrix transforms normals to export space, None if they already are
+        Return (normals, loops_to_normals) where normals are the unique normals to write as vn directives
+        and loops_to_normals maps a loop index to its (mesh-local, 0-based) vn index
+        """
+        corner_normals = loop_normals[corner_loops]
+        if normal_matrix is not None:
+            corner_normals = export_objex_mesh.transform_normals(corner_normals, normal_matrix)
+        first, corner_normal_indices = export_objex_mesh.unique_rows(export_objex_mesh.quantize(corner_normals, 4))
+
+        loops_to_normals = np.zeros(len(loop_normals), dtype=np.int64)
+        loops_to_normals[corner_loops] = corner_normal_indices
+        return corner_normals[first], loops_to_normals
     
-    def write_vertex_colors(self, mesh, face_index_pairs):
-        if not len(mesh.vertex_colors):
-            return None, 0
-        
-        fw = self.fw_objex
-        
-        vc_unique_count = 0
-        loops = mesh.loops
-        loop_colors = mesh.vertex_colors.active.data[:] # 421todo allow choosing a layer
-        
-        vc_key = vc_val = None
-        vertex_colors_to_idx = {}
-        loops_to_vertex_colors = [0] * len(loops)
-        for f, f_index in face_index_pairs:
-            for l_idx in f.loop_indices:
-                color = loop_colors[l_idx].color
-                # 3 digits: 1/256 ~ 0.0039
-                if len(color) == 3:
-                    # default to alpha = 1 (opaque)
-                    vc_key = (round(color[0], 3), round(color[1], 3), round(color[2], 3), 1.0)
-                else: # 4 (alpha)
-                    vc_key = (round(color[0], 3), round(color[1], 3), round(color[2], 3), round(color[3], 3))
-                vc_val = vertex_colors_to_idx.get(vc_key)
-                if vc_val is None:
-                    vc_val = vertex_colors_to_idx[vc_key] = vc_unique_count
-                    fw('vc %.3f %.3f %.3f %.3f\n' % vc_key)
-                    vc_unique_count += 1
-                loops_to_vertex_colors[l_idx] = vc_val
-        return loops_to_vertex_colors, vc_unique_count
+    def extract_vertex_colors(self, loop_colors, corner_loops):
+        """
+        loop_colors is the color of each loop
+        corner_loops is the array of loop indices in the order they are used by faces
+        Return (vertex_colors, loops_to_vertex_colors) where vertex_colors are the unique colors to write as vc directives
+        and loops_to_vertex_colors maps a loop index to its (mesh-local, 0-based) vc index
+        """
+        corner_colors = loop_colors[corner_loops]
+        # 3 digits: 1/256 ~ 0.0039
+        first, corner_color_indices = export_objex_mesh.unique_rows(export_objex_mesh.quantize(corner_colors, 3))
+
+        loops_to_vertex_colors = np.zeros(len(loop_colors), dtype=np.int64)
+        loops_to_vertex_colors[corner_loops] = corner_color_indices
+        return corner_colors[first], loops_to_vertex_colors
     
-    def write_object(self, progress, ob, ob_mat):
+    def log_memory_usage(self, phase):
+        """
+        Log the memory usage (resident set size) at the end of phase, how much it changed during phase,
+        and where supported (Linux) the peak memory usage during phase
+        """
+        rss = util.get_current_rss()
+        if rss is None or self.rss is None:
+            return
+        log = self.log.info if self.options['LOW_MEMORY'] else self.log.debug
+        if self.track_phase_peak_rss:
+            phase_peak_rss = util.get_peak_rss_since_reset()
+            util.reset_peak_rss()
+        else:
+            phase_peak_rss = None
+        if phase_peak_rss is not None:
+            log('Memory usage after {}: {:.1f} MiB ({:+.1f} MiB), peak during it: {:.1f} MiB',
+                phase, rss / (1 << 20), (rss - self.rss) / (1 << 20), phase_peak_rss / (1 << 20))
+        else:
+            log('Memory usage after {}: {:.1f} MiB ({:+.1f} MiB)',
+                phase, rss / (1 << 20), (rss - self.rss) / (1 << 20))
+        self.rss = rss
+
+    def get_converted_objects(self):
+        """
+        Return the objects which may be converted to meshes by write_object:
+        the exported objects, and the objects they instance (dupli children, instanced collections,
+        and in < 2.80 particle instances; in 2.80+ see get_new_instanced_objects)
+        """
+        objects = []
+        seen = set()
+        def add(ob):
+            if ob not in seen:
+                seen.add(ob)
+                objects.append(ob)
+        for ob in self.objects:
+            add(ob)
+            if hasattr(ob, 'dupli_type'): # < 2.80
+                instance_type = ob.dupli_type
+                instance_collection = ob.dupli_group
+            else: # 2.80+
+                instance_type = ob.instance_type
+                instance_collection = ob.instance_collection
+            if instance_type in {'VERTS', 'FACES'}:
+                for child in ob.children:
+                    add(child)
+            elif instance_type in {'GROUP', 'COLLECTION'} and instance_collection:
+                for child in (instance_collection.objects if hasattr(ob, 'dupli_type') else instance_collection.all_objects):
+                    add(child)
+            if hasattr(ob, 'dupli_type') and hasattr(ob, 'particle_systems'): # < 2.80
+                for particle_system in ob.particle_systems:
+                    settings = particle_system.settings
+                    if settings.render_type == 'OBJECT' and settings.dupli_object:
+                        add(settings.dupli_object)
+                    elif settings.render_type == 'GROUP' and settings.dupli_group:
+                        for child in settings.dupli_group.objects:
+                            add(child)
+        return objects
+
+    def get_new_instanced_objects(self, depsgraph, converted_objects):
+        """
+        Return the objects instanced by the exported objects in depsgraph (2.80+) which are not in converted_objects,
+        such as particle and geometry nodes instances (which can only be found once evaluated)
+        """
+        exported = set(self.objects)
+        converted = set(converted_objects)
+        objects = []
+        for instance in depsgraph.object_instances:
+            if not instance.is_instance or not instance.parent or instance.parent.original not in exported:
+                continue
+            ob = instance.instance_object.original
+            if ob not in converted:
+                converted.add(ob)
+                objects.append(ob)
+        return objects
+
+    def override_modifiers(self, objects):
+        """
+        Set the visibility of the modifiers of all objects for converting them to meshes:
+        disable armature deform modifiers (and the modifiers after them, according to options),
+        and in 2.80+ show the modifiers enabled for the viewport or render (according to options)
+        since the (viewport) depsgraph is used for evaluating them.
+        This is done for all objects at once so the depsgraph only needs to be evaluated once.
+        Return a list of (modifier, show_viewport, show_render) for restore_modifiers
+        """
         log = self.log
-        fw = self.fw_objex
-        scene = self.context.scene
-        
-        with ProgressReportSubstep(progress, 6) as subprogress2:
-
-            if self.options['EXPORT_SKEL'] and ob.type == 'ARMATURE':
-                if self.options['EXPORT_ANIM']:
-                    objex_data = ob.data.objex_bonus
-                    if objex_data.export_all_actions:
-                        actions = bpy.data.actions
-                    else:
-                        if blender_version_compatibility.no_ID_PointerProperty:
-                            actions = [bpy.data.actions[item.action] for item in objex_data.export_actions if item.action]
-                        else:
-                            actions = [item.action for item in objex_data.export_actions if item.action]
-                else:
-                    actions = []
-                self.armatures.append((util.quote(ob.name), ob, ob_mat, actions))
-
-            rigged_to_armature = ob.find_armature()
-
-            apply_modifiers = self.options['APPLY_MODIFIERS']
-            using_depsgraph = hasattr(self.context, 'evaluated_depsgraph_get') # True in 2.80+
-            # disable armature deform modifiers
-            user_show_armature_modifiers = []
-            if apply_modifiers:
+        using_depsgraph = hasattr(self.context, 'evaluated_depsgraph_get') # True in 2.80+
+        user_show_modifiers = []
+        if not self.options['APPLY_MODIFIERS']:
+            return user_show_modifiers
+        try:
+            for ob in objects:
+                if not hasattr(ob, 'modifiers'):
+                    continue
+                rigged_to_armature = ob.find_armature()
                 found_armature_deform = False
                 for modifier in ob.modifiers:
                     disable_modifier = False
@@ -257,142 +432,301 @@ class ObjexWriter():
                         modifier_show = False
                     elif using_depsgraph:
                         modifier_show = modifier.show_render if self.options['APPLY_MODIFIERS_RENDER'] else modifier.show_viewport
-                    if modifier_show is not None:
-                        user_show_armature_modifiers.append((modifier, modifier.show_viewport, modifier.show_render))
+                    if modifier_show is not None and (modifier.show_viewport, modifier.show_render) != (modifier_show, modifier_show):
+                        user_show_modifiers.append((modifier, modifier.show_viewport, modifier.show_render))
                         modifier.show_viewport = modifier_show
                         modifier.show_render = modifier_show
+        except:
+            # don't leave the modifiers changed so far
+            self.restore_modifiers(user_show_modifiers)
+            raise
+        log.debug('Changed the visibility of {:d} modifiers', len(user_show_modifiers))
+        return user_show_modifiers
+
+    def restore_modifiers(self, user_show_modifiers):
+        """Restore the modifiers visibility changed by override_modifiers, restoring as many as possible if some fail"""
+        failed = False
+        for modifier, user_show_viewport, user_show_render in user_show_modifiers:
+            try:
+                modifier.show_viewport = user_show_viewport
+                modifier.show_render = user_show_render
+            except Exception:
+                self.log.exception('Could not restore the visibility of modifier {!r}', modifier)
+                failed = True
+        if failed:
+            self.log.error('The visibility of some modifiers could not be restored, check show_viewport/show_render of modifiers')
+
+    def extract_mesh(self, ob, mesh_transform, flip):
+        """
+        Read the mesh of ob (with modifiers, according to options) into an ExtractedMesh
+        mesh_transform is applied to the mesh before reading it if not None (needed for normals with a non-uniform scale)
+        flip tells if the normals (and winding order) must be flipped, for a mirroring transform
+        Return None if there is nothing to write
+        """
+        scene = self.context.scene
 
-            if using_depsgraph: # 2.80+
-                depsgraph = self.context.evaluated_depsgraph_get()
-                ob_for_convert = ob.evaluated_get(depsgraph) if apply_modifiers else ob.original
-                del depsgraph
-            else:
-                ob_for_convert = None
+        rigged_to_armature = ob.find_armature()
+        apply_modifiers = self.options['APPLY_MODIFIERS']
 
-            try:
+        # modifiers visibility was set by override_modifiers and self.depsgraph evaluated once for all objects
+        if self.depsgraph is not None: # 2.80+
+            ob_for_convert = ob.evaluated_get(self.depsgraph) if apply_modifiers else ob.original
+        else:
+            ob_for_convert = None
+
+        try:
+            with tracing.span('to_mesh', object=ob.name):
                 if not ob_for_convert: # < 2.80
                     me = ob.to_mesh(scene, apply_modifiers, calc_tessface=False,
                                     settings='RENDER' if self.options['APPLY_MODIFIERS_RENDER'] else 'PREVIEW')
                 else: # 2.80+
                     # 421fixme should preserve_all_data_layers=True be used?
                     me = ob_for_convert.to_mesh()
-            except RuntimeError:
-                me = None
-            finally:
-                # restore modifiers properties
-                for modifier, user_show_viewport, user_show_render in user_show_armature_modifiers:
-                    modifier.show_viewport = user_show_viewport
-                    modifier.show_render = user_show_render
-
-            if me is None:
-                return
-
-            # _must_ do this before applying transformation, else tessellation may differ
-            if self.options['TRIANGULATE']:
-                if not all(len(polygon.vertices) == 3 for polygon in me.polygons):
-                    notes = []
-                    if any(modifier.type == 'TRIANGULATE' for modifier in ob.modifiers):
-                        notes.append('mesh has a triangulate modifier')
-                        if apply_modifiers:
-                            notes.append('even after applying modifiers')
-                        else:
-                            notes.append('modifiers are not being applied (check export options)')
-                        if rigged_to_armature and not self.options['APPLY_MODIFIERS_AFTER_ARMATURE_DEFORM']:
-                            notes.append('mesh is rigged and only modifiers before armature deform are used\n'
-                                '(move the triangulate modifier up, or check export options)')
-                    else:
-                        notes.append('mesh has no triangulate modifier')
-                    log.warning('Mesh {} is not triangulated and will be triangulated automatically (for exporting only).\n'
-                        'Preview accuracy (UVs, shading, vertex colors) is improved by using a triangulated mesh.'
-                        '{}', ob.name, ''.join('\nNote: %s' % note for note in notes))
-                    # _must_ do this first since it re-allocs arrays
-                    mesh_triangulate(me)
-                else:
-                    log.debug('Skipped triangulating {}, mesh only has triangles', ob.name)
-
-            me.transform(blender_version_compatibility.matmul(self.options['GLOBAL_MATRIX'], ob_mat))
-            # If negative scaling, we have to invert the normals...
-            if ob_mat.determinant() < 0.0:
-                me.flip_normals()
-
-            if self.options['EXPORT_UV']:
-                if hasattr(me, 'uv_textures'): # < 2.80
-                    has_uvs = len(me.uv_textures) > 0
-                    has_uv_textures = has_uvs
-                    if has_uv_textures:
-                        uv_texture = me.uv_textures.active.data[:]
-                else: # 2.80+
-                    has_uvs = len(me.uv_layers) > 0
-                    has_uv_textures = False
-            else:
-                has_uvs = False
-            
-            vertices = me.vertices[:]
+        except RuntimeError:
+            me = None
 
-            # Make our own list so it can be sorted to reduce context switching
-            face_index_pairs = [(face, index) for index, face in enumerate(me.polygons)]
-            # faces = [ f for f in me.tessfaces ]
+        if me is None:
+            return None
 
-            if not (len(face_index_pairs) + len(vertices)):  # Make sure there is something to write
-                # clean up
-                if not ob_for_convert: # < 2.80
-                    bpy.data.meshes.remove(me)
-                else: # 2.80+
-                    ob_for_convert.to_mesh_clear()
-                return  # dont bother with this mesh.
+        try:
+            with tracing.span('read_mesh', object=ob.name):
+                return self.read_mesh(ob, me, rigged_to_armature, mesh_transform, flip)
+        finally:
+            # clean up
+            if not ob_for_convert: # < 2.80
+                bpy.data.meshes.remove(me)
+            else: # 2.80+
+                ob_for_convert.to_mesh_clear()
 
-            if self.options['EXPORT_NORMALS'] and face_index_pairs:
-                me.calc_normals_split()
-                # No need to call me.free_normals_split later, as this mesh is deleted anyway!
+    def read_mesh(self, ob, me, rigged_to_armature, mesh_transform, flip):
+        """Read me, the mesh of ob, see extract_mesh"""
+        log = self.log
 
-            if self.options['EXPORT_SMOOTH_GROUPS'] and face_index_pairs:
-                smooth_groups, smooth_groups_tot = me.calc_smooth_groups(self.options['EXPORT_SMOOTH_GROUPS_BITFLAGS'])
-                if smooth_groups_tot <= 1:
-                    smooth_groups, smooth_groups_tot = (), 0
+        polygon_loop_starts, polygon_loop_totals = export_objex_mesh.get_polygon_loop_ranges(me)
+        # when triangulating (2.80+), faces are written from the loop triangles instead of the polygons
+        loop_triangles = None
+        # _must_ do this before applying transformation, else tessellation may differ
+        if self.options['TRIANGULATE']:
+            if (polygon_loop_totals != 3).any():
+                notes = []
+                if any(modifier.type == 'TRIANGULATE' for modifier in ob.modifiers):
+                    notes.append('mesh has a triangulate modifier')
+                    if self.options['APPLY_MODIFIERS']:
+                        notes.append('even after applying modifiers')
+                    else:
+                        notes.append('modifiers are not being applied (check export options)')
+                    if rigged_to_armature and not self.options['APPLY_MODIFIERS_AFTER_ARMATURE_DEFORM']:
+                        notes.append('mesh is rigged and only modifiers before armature deform are used\n'
+                            '(move the triangulate modifier up, or check export options)')
+                else:
+                    notes.append('mesh has no triangulate modifier')
+                log.warning('Mesh {} is not triangulated and will be triangulated automatically (for exporting only).\n'
+                    'Preview accuracy (UVs, shading, vertex colors) is improved by using a triangulated mesh.'
+                    '{}', ob.name, ''.join('\nNote: %s' % note for note in notes))
+                if hasattr(me, 'loop_triangles'): # 2.80+
+                    # the mesh is not modified, its tessellation is read now (before mesh_transform is applied)
+                    with tracing.span('triangulate', object=ob.name):
+                        loop_triangles = export_objex_mesh.get_loop_triangles(me)
+                else: # < 2.80
+                    # _must_ do this first since it re-allocs arrays
+                    with tracing.span('triangulate', object=ob.name):
+                        mesh_triangulate(me)
+                    polygon_loop_starts, polygon_loop_totals = export_objex_mesh.get_polygon_loop_ranges(me)
             else:
+                log.debug('Skipped triangulating {}, mesh only has triangles', ob.name)
+
+        if mesh_transform is not None:
+            # angles (for auto smooth, and for weighting face normals) are not preserved
+            # by a non-uniform scale, so the mesh itself has to be transformed for normals to be right
+            log.debug('Transforming mesh of {} before computing normals (non-uniform scale)', ob.name)
+            me.transform(mesh_transform)
+        # If negative scaling, we have to invert the normals...
+        if flip:
+            me.flip_normals()
+
+        if self.options['EXPORT_UV']:
+            if hasattr(me, 'uv_textures'): # < 2.80
+                has_uvs = len(me.uv_textures) > 0
+                has_uv_textures = has_uvs
+            else: # 2.80+
+                has_uvs = len(me.uv_layers) > 0
+                has_uv_textures = False
+        else:
+            has_uvs = has_uv_textures = False
+
+        mesh = ExtractedMesh()
+        mesh.rigged_to_armature = rigged_to_armature
+        # (vertex count, 3) array of vertex coordinates, in object space (or export space if mesh_transform was applied)
+        mesh.vertex_positions = export_objex_mesh.get_vertex_positions(me)
+        vertex_count = len(mesh.vertex_positions)
+
+        polygon_count = len(polygon_loop_totals)
+        mesh.loop_vertex_indices = export_objex_mesh.get_loop_vertex_indices(me)
+
+        if not (polygon_count + vertex_count):  # Make sure there is something to write
+            return None  # dont bother with this mesh.
+
+        if self.options['EXPORT_NORMALS'] and polygon_count and not hasattr(me, 'corner_normals'): # < 4.1
+            me.calc_normals_split()
+            # No need to call me.free_normals_split later, as this mesh is deleted anyway!
+
+        if self.options['EXPORT_SMOOTH_GROUPS'] and polygon_count:
+            smooth_groups, smooth_groups_tot = me.calc_smooth_groups(self.options['EXPORT_SMOOTH_GROUPS_BITFLAGS'])
+            if smooth_groups_tot <= 1:
                 smooth_groups, smooth_groups_tot = (), 0
+        else:
+            smooth_groups, smooth_groups_tot = (), 0
+        mesh.use_smooth_groups = bool(smooth_groups)
+
+        mesh.materials = me.materials[:]
+
+        mesh.polygon_material_indices = export_objex_mesh.get_polygon_material_indices(me)
+        # 0 for flat polygons, otherwise the smooth group (or 1 without smooth groups)
+        mesh.polygon_smooth = export_objex_mesh.get_polygon_use_smooth(me).astype(np.int64)
+        if smooth_groups:
+            mesh.polygon_smooth *= np.asarray(smooth_groups, dtype=np.int64)
+
+        mesh.polygon_images = [polygon_uv_texture.image for polygon_uv_texture in me.uv_textures.active.data] if has_uv_textures else None
+
+        # Sort by Material, then images
+        # so we dont over context switch in the obj file.
+        # polygon indices, in the order faces are written
+        if self.options['KEEP_VERTEX_ORDER']:
+            polygon_order = np.arange(polygon_count, dtype=np.int64)
+        else:
+            if has_uv_textures:
+                sort_keys = (
+                    mesh.polygon_material_indices,
+                    np.array([hash(image) for image in mesh.polygon_images], dtype=np.int64),
+                    mesh.polygon_smooth,
+                )
+            elif len(mesh.materials) > 1:
+                sort_keys = (mesh.polygon_material_indices, mesh.polygon_smooth)
+            else:
+                # no materials
+                sort_keys = (mesh.polygon_smooth,)
+            polygon_order = export_objex_mesh.get_sort_order(*sort_keys)
+            del sort_keys
+
+        # face_polygons: polygon index of each face, in written order
+        # corner_loops: loop indices, in the order faces use them
+        # face_sizes: corner count of each face
+        if loop_triangles is not None:
+            mesh.face_polygons, mesh.corner_loops, mesh.face_sizes = export_objex_mesh.get_triangle_faces(
+                *loop_triangles, polygon_order)
+            del loop_triangles
+        else:
+            mesh.face_polygons, mesh.corner_loops, mesh.face_sizes = export_objex_mesh.get_polygon_faces(
+                polygon_loop_starts, polygon_loop_totals, polygon_order)
+
+        # rig_is_exported is used to avoid referencing a skeleton or bones which aren't exported
+        mesh.rig_is_exported = self.options['EXPORT_SKEL'] and (rigged_to_armature in self.objects)
+
+        # Retrieve the list of vertex groups
+        vertex_group_names = ob.vertex_groups.keys()
+        if self.options['EXPORT_WEIGHTS'] and vertex_group_names and rigged_to_armature and mesh.rig_is_exported:
+            # only write vertex groups named after actual bones
+            # with UNIQUE_WEIGHTS only the group of maximum weight is written, with weight 1,
+            # otherwise all (non-zero) weights are written
+            mesh.vertex_weights = export_objex_mesh.get_vertex_weights(me, vertex_group_names,
+                [bone.name for bone in rigged_to_armature.data.bones], util.quote)
+        # no weights
+        else:
+            mesh.vertex_weights = None
+        del vertex_group_names
+
+        # per-loop data, None if not exported
+        mesh.loop_uvs = export_objex_mesh.get_loop_uvs(me.uv_layers.active) if has_uvs else None
+        # NORMAL, Smooth/Non smoothed.
+        mesh.loop_normals = export_objex_mesh.get_loop_normals(me) if self.options['EXPORT_NORMALS'] else None
+        mesh.loop_colors = export_objex_mesh.get_loop_colors(me, mesh.loop_vertex_indices) if self.options['EXPORT_VERTEX_COLORS'] else None
+
+        return mesh
+
+    def get_armature_actions(self, ob):
+        """Return the actions to export with the armature object ob"""
+        if not self.options['EXPORT_ANIM']:
+            return []
+        objex_data = ob.data.objex_bonus
+        if objex_data.export_all_actions:
+            return bpy.data.actions
+        if blender_version_compatibility.no_ID_PointerProperty:
+            return [bpy.data.actions[item.action] for item in objex_data.export_actions if item.action]
+        return [item.action for item in objex_data.export_actions if item.action]
+
+    def get_progress(self):
+        """Return the progress of write_iter, from 0 to 1"""
+        if not self.progress_total:
+            return 0
+        return min(self.progress_done / self.progress_total, 1)
+
+    def write_object(self, progress, ob, ob_mat, shared=False):
+        """
+        Extract the data of ob to write from Blender into a MeshBlock, which is formatted and written by self.block_writer
+        The directives written before the faces (g, attrib, usemtl...) are already formatted here
+        With shared=True (instances), the mesh is read once per object and kept for the next instances of it
+        """
+        log = self.log
+        
+        with ProgressReportSubstep(progress, 6) as subprogress2, tracing.span('write_object', object=ob.name):
 
-            materials = me.materials[:]
-            use_materials = materials and self.options['EXPORT_MTL']
-
-            # Sort by Material, then images
-            # so we dont over context switch in the obj file.
-            if self.options['KEEP_VERTEX_ORDER']:
-                pass
+            if self.options['EXPORT_SKEL'] and ob.type == 'ARMATURE':
+                self.armatures.append((util.quote(ob.name), ob, ob_mat, self.get_armature_actions(ob)))
+                # the skeleton doesn't depend on the current frame, unlike animations which are written at the end
+                export_objex_anim.write_armature_skeleton(self.skel_output.write, self.options['GLOBAL_MATRIX'],
+                    ob_mat, ob, util.quote(ob.name), self.binary_writer,
+                    self.index.get_recorder(self.skel_output) if self.index else None)
+
+            # the mesh is not transformed, instead coordinates are transformed in bulk when writing them
+            # normals are computed in object space and transformed with normal_matrix when writing them
+            transform = blender_version_compatibility.matmul(self.options['GLOBAL_MATRIX'], ob_mat)
+            if self.options['EXPORT_NORMALS'] and not export_objex_mesh.is_uniform_scale(transform):
+                mesh_transform = transform
+                transform = mathutils.Matrix.Identity(4)
             else:
-                if has_uv_textures:
-                    if smooth_groups:
-                        sort_func = lambda a: (a[0].material_index,
-                                               hash(uv_texture[a[1]].image),
-                                               smooth_groups[a[1]] if a[0].use_smooth else False)
-                    else:
-                        sort_func = lambda a: (a[0].material_index,
-                                               hash(uv_texture[a[1]].image),
-                                               a[0].use_smooth)
-                elif len(materials) > 1:
-                    if smooth_groups:
-                        sort_func = lambda a: (a[0].material_index,
-                                               smooth_groups[a[1]] if a[0].use_smooth else False)
-                    else:
-                        sort_func = lambda a: (a[0].material_index,
-                                               a[0].use_smooth)
+                mesh_transform = None
+            flip = ob_mat.determinant() < 0.0
+
+            # a mesh transformed by mesh_transform can't be shared, but the (at most two) flip variants can
+            if shared and mesh_transform is None:
+                mesh_key = (ob, flip)
+                if mesh_key in self.shared_meshes:
+                    mesh = self.shared_meshes[mesh_key]
+                    log.debug('Reusing the mesh of {} for an instance', ob.name)
                 else:
-                    # no materials
-                    if smooth_groups:
-                        sort_func = lambda a: smooth_groups[a[1] if a[0].use_smooth else False]
-                    else:
-                        sort_func = lambda a: a[0].use_smooth
-
-                face_index_pairs.sort(key=sort_func)
+                    mesh = self.shared_meshes[mesh_key] = self.extract_mesh(ob, None, flip)
+            else:
+                mesh = self.extract_mesh(ob, mesh_transform, flip)
+            if self.options['LOW_MEMORY']:
+                self.log_memory_usage('extracting %s' % ob.name)
+            if mesh is None:
+                return
 
-                del sort_func
+            # the cofactor matrix of the 3x3 part, up to a positive factor
+            # it also accounts for the winding order change when the transform mirrors the mesh
+            transform3 = transform.to_3x3()
+            if transform3 == mathutils.Matrix.Identity(3):
+                normal_matrix = None
+            else:
+                normal_matrix = transform3.inverted_safe().transposed()
+                if transform3.determinant() < 0.0:
+                    normal_matrix = normal_matrix * -1
+
+            # (vertex count, 3) array of vertex coordinates in export space
+            vertex_positions = export_objex_mesh.transform_points(mesh.vertex_positions, transform)
+            rigged_to_armature = mesh.rigged_to_armature
+            rig_is_exported = mesh.rig_is_exported
+            loop_vertex_indices = mesh.loop_vertex_indices
+            corner_loops = mesh.corner_loops
+            face_polygons = mesh.face_polygons
+            face_sizes = mesh.face_sizes
 
             util.detect_zztag(log, ob.name)
+            # directives written before the v directives
+            header = []
+            fw = header.append
             fw('g %s\n' % util.quote(ob.name))
 
-            # rig_is_exported is used to avoid referencing a skeleton or bones which aren't exported
-            rig_is_exported = self.options['EXPORT_SKEL'] and (rigged_to_armature in self.objects)
-
             if ob.type == 'MESH':
                 objex_data = ob.data.objex_bonus # ObjexMeshProperties
                 if objex_data.priority != 0:
@@ -422,96 +756,131 @@ class ObjexWriter():
 
             subprogress2.step()
 
-            if self.options['EXPORT_WEIGHTS']:
-                # Retrieve the list of vertex groups
-                vertGroupNames = ob.vertex_groups.keys()
-                vertex_groups = None
-                if vertGroupNames:
-                    # Create a dictionary keyed by vertex id and listing, for each vertex, the name of the vertex groups it belongs to, and its associated weight
-                    vertex_groups = [[] for _i in range(len(vertices))]
-                    for v_idx, v_ls in enumerate(vertex_groups):
-                        v_ls[:] = [(vertGroupNames[g.group], util.quote(vertGroupNames[g.group]), g.weight) for g in vertices[v_idx].groups]
-                del vertGroupNames
-
             # Vert
             if rigged_to_armature and rig_is_exported:
                 fw('useskel %s\n' % util.quote(rigged_to_armature.name))
-            if self.options['EXPORT_WEIGHTS'] and vertex_groups and rigged_to_armature and rig_is_exported:
-                # only write vertex groups named after actual bones
-                bone_names = [bone.name for bone in rigged_to_armature.data.bones]
-                bone_vertex_groups = [
-                    [(group_name_q, weight) for group_name, group_name_q, weight in vertex_vertex_groups if group_name in bone_names]
-                    for vertex_vertex_groups in vertex_groups
-                ]
-                # only group of maximum weight, with weight 1
-                if self.options['UNIQUE_WEIGHTS']:
-                    for v in vertices:
-                        groups = bone_vertex_groups[v.index] # list of (group_name_q, group_weight) tuples for that vertex
-                        if groups:
-                            group_name_q, weight = max(groups, key=lambda _g: _g[1])
-                            fw('%s %s\n' % (
-                                'v %.6f %.6f %.6f' % v.co[:],
-                                'weight %s 1' % group_name_q
-                            ))
-                        else:
-                            fw('v %.6f %.6f %.6f\n' % v.co[:])
-                # all (non-zero) weights
-                else:
-                    for v in vertices:
-                        fw('%s%s\n' % (
-                            'v %.6f %.6f %.6f' % v.co[:],
-                            ','.join([' weight %s %.3f' % (group_name_q, weight) for group_name_q, weight in bone_vertex_groups[v.index] if weight != 0])
-                        ))
-            # no weights
-            else:
-                for v in vertices:
-                    fw('v %.6f %.6f %.6f\n' % v.co[:])
+            vertex_weights = mesh.vertex_weights
 
             subprogress2.step()
 
-            # UV
-            if has_uvs:
-                uv_face_mapping, uv_unique_count = self.write_uvs(me, face_index_pairs)
+            # the cached data only depends on those arrays, headers and usemtl/s directives are always rebuilt
+            if self.object_cache:
+                cache_key = self.object_cache.get_key((
+                    vertex_positions, loop_vertex_indices, corner_loops, face_sizes,
+                    None if vertex_weights is None else vertex_weights.offsets,
+                    None if vertex_weights is None else vertex_weights.bone_indices,
+                    None if vertex_weights is None else vertex_weights.weights,
+                    mesh.loop_uvs, mesh.loop_normals,
+                    None if normal_matrix is None else export_objex_mesh.matrix_to_array(normal_matrix),
+                    mesh.loop_colors,
+                ), (
+                    None if vertex_weights is None else vertex_weights.bone_names_q,
+                    self.options['UNIQUE_WEIGHTS'],
+                ))
+                cached = self.object_cache.load(cache_key)
             else:
-                uv_unique_count = 0
-            
-            subprogress2.step()
-
-            # NORMAL, Smooth/Non smoothed.
-            if self.options['EXPORT_NORMALS']:
-                loops_to_normals, no_unique_count = self.write_normals(me, face_index_pairs)
-                has_normals = True
+                cached = None
+
+            if cached:
+                log.debug('Using cached data for {}', ob.name)
+                text, counts, columns, corner_indices = cached
+                mesh_data = export_objex_mesh.FormattedMeshData(text, counts, columns)
+                cache_path = None
+                del text, counts, columns, cached
             else:
-                no_unique_count = 0
-                has_normals = False
-            
-            if self.options['EXPORT_VERTEX_COLORS']:
-                loops_to_vertex_colors, vc_unique_count = self.write_vertex_colors(me, face_index_pairs)
-                has_vertex_colors = loops_to_vertex_colors is not None
-            else:
-                has_vertex_colors = False
-                vc_unique_count = 0
+                # UV and vertex colors don't depend on the transform, they are extracted once for all instances
+                # UV
+                if mesh.loop_uvs is not None and mesh.uvs is None:
+                    with tracing.span('extract_uvs', object=ob.name):
+                        mesh.uvs, mesh.loops_to_uvs = self.extract_uvs(mesh.loop_uvs, corner_loops, loop_vertex_indices)
+                uvs = mesh.uvs
+                
+                # normals are (re)deduplicated after transforming them, as rounding depends on the transform
+                if mesh.loop_normals is not None:
+                    with tracing.span('extract_normals', object=ob.name):
+                        normals, loops_to_normals = self.extract_normals(mesh.loop_normals, corner_loops, normal_matrix)
+                else:
+                    normals = None
+                
+                if mesh.loop_colors is not None and mesh.vertex_colors is None:
+                    with tracing.span('extract_vertex_colors', object=ob.name):
+                        mesh.vertex_colors, mesh.loops_to_vertex_colors = self.extract_vertex_colors(mesh.loop_colors, corner_loops)
+                vertex_colors = mesh.vertex_colors
+
+                mesh_data = export_objex_mesh.MeshData(vertex_positions, vertex_weights, self.options['UNIQUE_WEIGHTS'],
+                    uvs, normals, vertex_colors)
+
+                # (mesh-local) indices of the v/vt/vn/vc data of each face corner
+                corner_columns = [loop_vertex_indices[corner_loops]]
+                if uvs is not None:
+                    corner_columns.append(mesh.loops_to_uvs[corner_loops])
+                if normals is not None:
+                    corner_columns.append(loops_to_normals[corner_loops])
+                if vertex_colors is not None:
+                    corner_columns.append(mesh.loops_to_vertex_colors[corner_loops])
+                corner_indices = np.column_stack(corner_columns).astype(np.int64)
+                del corner_columns
+
+                cache_path = self.object_cache.get_path(cache_key) if self.object_cache else None
 
             subprogress2.step()
 
-            # those context_* variables are used to keep track of the last g/usemtl/s directive written, according to options
-            # Set the default mat to no material and no image.
-            context_material = context_face_image = 0  # Can never be this, so we will label a new material the first chance we get. used for usemtl directives if EXPORT_MTL
-            context_smooth = None  # Will either be true or false,  set bad to force initialization switch. with EXPORT_SMOOTH_GROUPS, has effects on writing the s directive
-
-            for f, f_index in face_index_pairs:
-                f_smooth = f.use_smooth
-                if f_smooth and smooth_groups:
-                    f_smooth = smooth_groups[f_index]
-
-                face_material = materials[f.material_index] if use_materials else None
-                face_image = uv_texture[f_index].image if has_uv_textures else None
-
+            # per-face (in written order) data deciding the usemtl/s directives
+            materials = mesh.materials
+            use_materials = materials and self.options['EXPORT_MTL']
+            face_count = len(face_polygons)
+            # "contexts" are (material, image) pairs, face_context_ids[i] is the index in contexts of the context of face i
+            contexts = []
+            context_ids = {}
+            def get_context_id(face_material, face_image):
                 # we do not need to switch context when the face image changes if
                 # the (objex) material doesn't change, as the face image is completely ignored
                 # when using objex materials
                 if face_material and face_material.objex_bonus.is_objex_material:
                     face_image = None
+                context_id = context_ids.get((face_material, face_image))
+                if context_id is None:
+                    context_id = context_ids[(face_material, face_image)] = len(contexts)
+                    contexts.append((face_material, face_image))
+                return context_id
+            if use_materials:
+                face_material_indices = mesh.polygon_material_indices[face_polygons]
+                out_of_range = (face_material_indices < 0) | (face_material_indices >= len(materials))
+                if out_of_range.any():
+                    # like Blender does when drawing the mesh
+                    log.warning('Object {} has {:d} faces with a material index out of range (of {:d} material slots), '
+                        'using the last material slot for them', ob.name, int(np.count_nonzero(out_of_range)), len(materials))
+                    face_material_indices = face_material_indices.clip(0, len(materials) - 1)
+            else:
+                face_material_indices = np.zeros(face_count, dtype=np.int32)
+            if mesh.polygon_images is not None:
+                face_context_ids = np.array([
+                    get_context_id(materials[material_index] if use_materials else None, mesh.polygon_images[f_index])
+                    for material_index, f_index in zip(face_material_indices.tolist(), face_polygons.tolist())
+                ], dtype=np.int64)
+            else:
+                slot_context_ids = np.array([
+                    get_context_id(material, None) for material in (materials if use_materials else [None])
+                ], dtype=np.int64)
+                face_context_ids = slot_context_ids[face_material_indices]
+            face_smooth = mesh.polygon_smooth[face_polygons]
+
+            # those context_* variables are used to keep track of the last g/usemtl/s directive written, according to options
+            # Set the default mat to no material and no image.
+            context_material = context_face_image = 0  # Can never be this, so we will label a new material the first chance we get. used for usemtl directives if EXPORT_MTL
+            context_smooth = None  # Will either be true or false,  set bad to force initialization switch. with EXPORT_SMOOTH_GROUPS, has effects on writing the s directive
+            # amount of usemtl/clearmtl directives, for stats
+            material_switches = 0
+
+            # faces are written by runs of faces sharing the same context and smooth value
+            # runs: (run start, run end, directives to write before the faces of the run)
+            runs = []
+            run_starts = export_objex_mesh.get_run_starts(face_context_ids, face_smooth).tolist()
+            for run_start, run_end in zip(run_starts, run_starts[1:] + [face_count]):
+                run_directives = []
+                fw = run_directives.append
+                face_material, face_image = contexts[face_context_ids[run_start]]
+                f_smooth = int(face_smooth[run_start])
 
                 # if context hasn't changed, do nothing
                 if context_material == face_material and context_face_image == face_image:
@@ -520,6 +889,8 @@ class ObjexWriter():
                     # update context
                     context_material = face_material
                     context_face_image = face_image
+                    if self.options['EXPORT_MTL']:
+                        material_switches += 1
 
                     # clear context
                     if face_material is None and face_image is None:
@@ -536,11 +907,7 @@ class ObjexWriter():
                             name_base = face_material.name if face_material else 'None'
                             if face_image:
                                 name_base = '%s %s' % (name_base, face_image.name)
-                            name = name_base
-                            i = 0
-                            while name in (_name for (_name, _name_q, _material, _face_image) in self.mtl_dict.values()):
-                                i += 1
-                                name = '%s %d' % (name_base, i)
+                            name = self.mtl_names.allocate(name_base)
                             name_q = util.quote(name)
                             # remember the pair
                             self.mtl_dict[(face_material, face_image)] = name, name_q, face_material, face_image
@@ -572,13 +939,16 @@ class ObjexWriter():
                                         .format(ob.name, face_material.name)
                                     )
 
+                                # write the material to .mtlex now, along the geometry
+                                with tracing.span('write_mtl', material=name):
+                                    self.mtl_writer.send(self.mtl_dict[(face_material, face_image)])
+
                         if self.options['EXPORT_MTL']:
                             fw('usemtl %s\n' % name_q)
 
                 if f_smooth != context_smooth:
                     if f_smooth:  # on now off
-                        if smooth_groups:
-                            f_smooth = smooth_groups[f_index]
+                        if mesh.use_smooth_groups:
                             fw('s %d\n' % f_smooth)
                         else:
                             fw('s 1\n')
@@ -586,63 +956,139 @@ class ObjexWriter():
                         fw('s off\n')
                     context_smooth = f_smooth
 
-                f_v = [(vi, vertices[v_idx], l_idx)
-                       for vi, (v_idx, l_idx) in enumerate(zip(f.vertices, f.loop_indices))]
-
-                fw('f')
-                for vi, v, li in f_v:
-                    f_v_data = []
-                    f_v_data.append(self.total_vertex + v.index)
-                    if has_uvs:
-                        f_v_data.append(self.total_uv + uv_face_mapping[f_index][vi])
-                    if has_normals:
-                        f_v_data += [None] * (2 - len(f_v_data))
-                        f_v_data.append(self.total_normal + loops_to_normals[li])
-                    if has_vertex_colors:
-                        f_v_data += [None] * (3 - len(f_v_data))
-                        f_v_data.append(self.total_vertex_color + loops_to_vertex_colors[li])
-                    # v[/vt[/vn[/vc]]] coordinates/uv/normal/color
-                    fw(' %s' % '/'.join(['' if _i is None else ('%d' % _i) for _i in f_v_data]))
-                fw('\n')
+                runs.append((run_start, run_end, ''.join(run_directives)))
+
+            block = export_objex_mesh.MeshBlock(''.join(header), mesh_data, corner_indices, face_sizes, runs, cache_path)
+            offsets = (self.total_vertex, self.total_uv, self.total_normal, self.total_vertex_color)
+            if self.options['LOW_MEMORY']:
+                self.log_memory_usage('building the block of %s' % ob.name)
+            if self.block_writer:
+                if self.index:
+                    # the block may be written later, once formatted
+                    before_write = functools.partial(self.index.add_record, self.objex_output, 'g', ob.name,
+                                                     base=dict(zip(('v', 'vt', 'vn', 'vc'), offsets)))
+                else:
+                    before_write = None
+                # formats and writes the faces, or waits for the formatting processes
+                with tracing.span('write_mesh_block', object=ob.name):
+                    self.block_writer.write(block, offsets, before_write)
+                if self.options['LOW_MEMORY']:
+                    # formatting processes aren't used in low memory mode, the block is formatted while written
+                    self.log_memory_usage('formatting and writing %s' % ob.name)
+            if self.binary_writer:
+                with tracing.span('write binary block', object=ob.name):
+                    self.binary_writer.add_mesh_block(ob.name, block, offsets)
 
             subprogress2.step()
 
             # Make the indices global rather then per mesh
-            self.total_vertex += len(vertices)
+            vertex_count, uv_unique_count, no_unique_count, vc_unique_count = block.get_counts()
+            self.total_vertex += vertex_count
             self.total_uv += uv_unique_count
             self.total_normal += no_unique_count
             self.total_vertex_color += vc_unique_count
-            
-            # clean up
-            if not ob_for_convert: # < 2.80
-                bpy.data.meshes.remove(me)
-            else: # 2.80+
-                ob_for_convert.to_mesh_clear()
+
+            if self.stats:
+                has_uvs, has_normals, has_vertex_colors = block.data.get_columns()
+                self.stats.add_object(ob.name, vertex_count, face_count, len(corner_indices),
+                    uv_unique_count if has_uvs else None,
+                    no_unique_count if has_normals else None,
+                    vc_unique_count if has_vertex_colors else None,
+                    material_switches, bool(cached))
     
     def write(self, filepath):
+        """Export to filepath in one go, see write_iter"""
+        for _ in self.write_iter(filepath):
+            pass
+
+    def write_iter(self, filepath, report_progress=True):
         """
-        This function starts the exporting. It defines a few "globals" as class members, notably the total_* variables
+        This generator does the exporting. It defines a few "globals" as class members, notably the total_* variables
         It loops through objects, writing each to .objex (with the write_object method), and collecting materials/armatures/animations as it goes.
-        Once the .objex is finished being written, write_mtl is called to write the .mtl and same thing with write_anim which writes .anim and itself calls .skel which writes .skel
+        Materials and skeletons are written to .mtlex and .skel as they are found,
+        and once the .objex is finished being written, write_armatures_iter writes .anim
+        It yields after each object and each animation frame, with get_progress telling how far along the export is,
+        so the export can be spread over several calls (see OBJEX_OT_export.modal)
+        Closing the generator early stops the export, restoring the scene state
+        (with ATOMIC_WRITE the existing files are left as they were, otherwise they are left incomplete)
+        Objects must not be in edit mode, create_writer takes care of it
+        report_progress: use the window manager progress indicator
         """
         log = self.log
         self.filepath = filepath
-        with ProgressReport(self.context.window_manager) as progress:
+        # memory usage at the end of the last phase, see log_memory_usage
+        self.rss = util.get_current_rss()
+        if self.rss is None and self.options['LOW_MEMORY']:
+            log.info('Memory usage of each step can not be measured on this platform')
+        # the peak memory usage of the process is reset at the start of each phase, if possible
+        self.track_phase_peak_rss = self.rss is not None and util.reset_peak_rss()
+        if self.options['OBJECT_CACHE']:
+            self.object_cache = export_objex_cache.ObjectCache(export_objex_cache.get_cache_directory(filepath))
+        else:
+            self.object_cache = None
+        self.stats = export_objex_stats.ExportStats() if self.options['STATS'] else None
+        self.index = export_objex_index.ExportIndex() if self.options['INDEX'] else None
+        binary_container = self.options['BINARY_CONTAINER']
+        if binary_container != 'NONE' and self.object_cache:
+            log.info('The object cache is not used when writing a binary container (it only holds text)')
+            self.object_cache = None
+        if self.options['TRACE']:
+            trace_path = tracing.get_trace_path(filepath)
+            log.info('Writing a trace of the export to {}', trace_path)
+        else:
+            trace_path = None
+        # the trace is written last, after the background_writer finished writing files
+        # outputs are committed (with ATOMIC_WRITE, moved in place if changed) once the export succeeded,
+        # after everything is written and before background_writer stops
+        with tracing.Recording(trace_path), output_sink.BackgroundWriter() as background_writer, \
+                output_sink.AtomicOutputs() as outputs, \
+                contextlib.ExitStack() as binary_output, \
+                ProgressReport(self.context.window_manager if report_progress else None) as progress:
+            # OutputSink objects of all files written, see open_output
+            self.outputs = outputs.sinks
+            # hashers of the content of outputs, for a content exportid
+            self.content_hashers = []
+            # with BACKGROUND_WRITE, files are written by the background_writer thread while the export goes on
+            self.background_writer = background_writer if self.options['BACKGROUND_WRITE'] else None
+            # the binary container gets geometry, material names, skeletons and animations as they are written
+            if binary_container != 'NONE':
+                self.binary_writer = binary_output.enter_context(export_objex_binary.ContainerWriter(
+                    self.open_output(export_objex_binary.get_container_path(filepath), binary=True)))
+            else:
+                self.binary_writer = None
             scene = self.context.scene
 
-            # Exit edit mode before exporting, so current object states are exported properly.
-            if bpy.ops.object.mode_set.poll():
-                bpy.ops.object.mode_set(mode='OBJECT')
-
             # EXPORT THE FILE.
             progress.enter_substeps(1)
             
             with ProgressReportSubstep(progress, 3, "Objex Export path: %r" % filepath, "Objex Export Finished") as subprogress1:
-                with open(filepath, "w", encoding="utf8", newline="\n") as f:
-                    self.fw_objex = f.write
+                # objects are extracted by write_object, and formatted and written in order by block_writer
+                # (unless only the binary container is written)
+                with contextlib.ExitStack() as objex_output:
+                    if binary_container != 'INSTEAD':
+                        f = objex_output.enter_context(self.open_output(self.get_text_output_path(filepath)))
+                        self.objex_output = f
+                        self.fw_objex = f.write
+                        self.block_writer = objex_output.enter_context(export_objex_mesh.MeshBlockWriter(f.write,
+                            self.create_format_pool(), max_pending=2 * self.options['FORMAT_PROCESSES']))
+                    else:
+                        header = []
+                        self.objex_output = None
+                        self.fw_objex = header.append
+                        self.block_writer = None
 
                     # write leading comments, mtllib/animlib/skellib directives, and defines filepath_* to write .mtl/... to
                     self.write_header()
+                    if binary_container == 'INSTEAD':
+                        self.binary_writer.meta['header'] = ''.join(header)
+                        del header
+
+                    # skeletons are written to .skel as write_object finds armatures
+                    if self.options['EXPORT_SKEL']:
+                        self.skel_output = objex_output.enter_context(self.open_output(self.filepath_skel))
+                        self.write_export_id_line(self.skel_output)
+                    else:
+                        self.skel_output = None
 
                     # Initialize totals, these are updated each object
                     self.total_vertex = self.total_uv = self.total_normal = self.total_vertex_color = 1
@@ -652,107 +1098,206 @@ class ObjexWriter():
                     # (material, image): (name, name_q, material, face_image)
                     # name_q = util.quote(name)
                     self.mtl_dict = {}
+                    # names used in mtl_dict
+                    self.mtl_names = util.UniqueNames('%s %d')
 
                     copy_set = set()
 
                     self.armatures = []
-                    
-                    # Get all meshes
-                    subprogress1.enter_substeps(len(self.objects))
-                    for ob_main in self.objects:
-                        # 421todo I don't know what this dupli stuff is about
-                        # ("instancer" stuff in 2.80+)
-                        use_old_dupli = hasattr(ob_main, 'dupli_type') # True in < 2.80
-                        # ignore dupli children
-                        if (ob_main.parent
-                            and (ob_main.parent.dupli_type if use_old_dupli else ob_main.parent.instance_type)
-                                    in {'VERTS', 'FACES'}
-                        ):
-                            subprogress1.step("Ignoring %s, dupli child..." % ob_main.name)
-                            continue
-
-                        obs = [(ob_main, ob_main.matrix_world)]
-                        added_dupli_children = True
-                        if use_old_dupli and ob_main.dupli_type != 'NONE':
-                            # XXX
-                            log.info('creating dupli_list on {}', ob_main.name)
-                            ob_main.dupli_list_create(scene)
-
-                            obs += [(dob.object, dob.matrix) for dob in ob_main.dupli_list]
-                        elif not use_old_dupli and ob_main.is_instancer:
-                            # evaluated_depsgraph_get may be called in-between this line executing,
-                            # ie in write_object when evaluating mesh data, so call it again every time here
-                            depsgraph = self.context.evaluated_depsgraph_get()
-                            obs += [(dup.instance_object.original, dup.matrix_world.copy())
-                                    for dup in depsgraph.object_instances
-                                    if dup.parent and dup.parent.original == ob_main]
-                            del depsgraph
-                        else:
-                            added_dupli_children = False
-                        if added_dupli_children:
-                            log.debug('{} has {:d} dupli children', ob_main.name, len(obs) - 1)
-
-                        subprogress1.enter_substeps(len(obs))
-                        for ob, ob_mat in obs:
-                            self.write_object(subprogress1, ob, ob_mat)
 
-                        if use_old_dupli and ob_main.dupli_type != 'NONE':
-                            ob_main.dupli_list_clear()
-                        elif not use_old_dupli:
-                            pass # no clean-up needed
-
-                        subprogress1.leave_substeps("Finished writing geometry of '%s'." % ob_main.name)
-                    subprogress1.leave_substeps()
+                    # {(object, flip): ExtractedMesh or None} meshes of dupli children, read once for all their instances
+                    self.shared_meshes = {}
+                    
+                    # change the modifiers visibility of all objects at once and evaluate the depsgraph once,
+                    # instead of once per object (each change invalidates the depsgraph)
+                    converted_objects = self.get_converted_objects()
+                    with tracing.span('override_modifiers'):
+                        user_show_modifiers = self.override_modifiers(converted_objects)
+                    self.mtl_writer = None
+                    try:
+                        # materials are written to .mtlex as write_object finds them
+                        if self.options['EXPORT_MTL']:
+                            def append_header_mtl(mtlfile):
+                                self.write_export_id_line(mtlfile)
+                            self.mtl_writer = export_objex_mtl.write_mtl_incremental(scene, self.filepath_mtl,
+                                append_header_mtl, self.options, copy_set, self.open_output, self.index)
+                            next(self.mtl_writer)
+
+                        if hasattr(self.context, 'evaluated_depsgraph_get'): # 2.80+
+                            with tracing.span('evaluate depsgraph'):
+                                self.depsgraph = self.context.evaluated_depsgraph_get()
+                            # objects instanced by particles or geometry nodes are only known once evaluated,
+                            # override their modifiers too and evaluate again (only needed if there are any)
+                            while True:
+                                new_objects = self.get_new_instanced_objects(self.depsgraph, converted_objects)
+                                if not new_objects:
+                                    break
+                                log.debug('Found {:d} more instanced objects to override the modifiers of', len(new_objects))
+                                converted_objects.extend(new_objects)
+                                with tracing.span('override_modifiers', instanced=len(new_objects)):
+                                    user_show_modifiers.extend(self.override_modifiers(new_objects))
+                                with tracing.span('evaluate depsgraph'):
+                                    self.depsgraph = self.context.evaluated_depsgraph_get()
+                        else: # < 2.80
+                            self.depsgraph = None
+
+                        # one progress unit per object and per animation frame
+                        self.progress_done = 0
+                        self.progress_total = len(self.objects)
+                        if self.options['EXPORT_SKEL'] and self.options['EXPORT_ANIM']:
+                            self.progress_total += sum(
+                                export_objex_anim.get_action_frame_count(action)
+                                for ob in self.objects if ob.type == 'ARMATURE' and ob.animation_data
+                                for action in self.get_armature_actions(ob)
+                            )
+
+                        # Get all meshes
+                        subprogress1.enter_substeps(len(self.objects))
+                        for ob_main in self.objects:
+                            # 421todo I don't know what this dupli stuff is about
+                            # ("instancer" stuff in 2.80+)
+                            use_old_dupli = hasattr(ob_main, 'dupli_type') # True in < 2.80
+                            # ignore dupli children
+                            if (ob_main.parent
+                                and (ob_main.parent.dupli_type if use_old_dupli else ob_main.parent.instance_type)
+                                        in {'VERTS', 'FACES'}
+                            ):
+                                subprogress1.step("Ignoring %s, dupli child..." % ob_main.name)
+                                self.progress_done += 1
+                                continue
+
+                            obs = [(ob_main, ob_main.matrix_world)]
+                            added_dupli_children = True
+                            if use_old_dupli and ob_main.dupli_type != 'NONE':
+                                # XXX
+                                log.info('creating dupli_list on {}', ob_main.name)
+                                ob_main.dupli_list_create(scene)
+
+                                obs += [(dob.object, dob.matrix) for dob in ob_main.dupli_list]
+                            elif not use_old_dupli and ob_main.is_instancer:
+                                obs += [(dup.instance_object.original, dup.matrix_world.copy())
+                                        for dup in self.depsgraph.object_instances
+                                        if dup.parent and dup.parent.original == ob_main]
+                            else:
+                                added_dupli_children = False
+                            if added_dupli_children:
+                                log.debug('{} has {:d} dupli children', ob_main.name, len(obs) - 1)
+
+                            subprogress1.enter_substeps(len(obs))
+                            for i, (ob, ob_mat) in enumerate(obs):
+                                # obs[0] is ob_main, the next objects are dupli children
+                                self.write_object(subprogress1, ob, ob_mat, shared=i > 0)
+
+                            if use_old_dupli and ob_main.dupli_type != 'NONE':
+                                ob_main.dupli_list_clear()
+                            elif not use_old_dupli:
+                                pass # no clean-up needed
+
+                            if self.options['LOW_MEMORY']:
+                                # keep meshes of dupli children only for the instances of one object
+                                self.shared_meshes.clear()
+
+                            subprogress1.leave_substeps("Finished writing geometry of '%s'." % ob_main.name)
+                            self.progress_done += 1
+                            yield
+                        subprogress1.leave_substeps()
+
+                        if self.mtl_writer:
+                            export_objex_mtl.finish_mtl_incremental(self.mtl_writer)
+                    finally:
+                        self.restore_modifiers(user_show_modifiers)
+                        del self.depsgraph
+                        # closes the .mtlex if the export failed (nothing to do if it was finished)
+                        if self.mtl_writer:
+                            self.mtl_writer.close()
+                        del self.mtl_writer
+                    del self.shared_meshes
 
                 del self.fw_objex
+                del self.objex_output
+                del self.block_writer
+                del self.skel_output
+                self.log_memory_usage('geometry, materials and skeletons')
                 
-                subprogress1.step("Finished exporting geometry, now exporting materials")
+                subprogress1.step("Finished exporting geometry, materials and skeletons")
 
-                # Now we have all our materials, save them
-                if self.options['EXPORT_MTL']:
-                    def append_header_mtl(fw_mtl):
-                        fw_mtl(self.export_id_line)
-                    export_objex_mtl.write_mtl(scene, self.filepath_mtl, append_header_mtl, self.options, copy_set, self.mtl_dict)
+                # animations are written after the geometry since writing them changes the current frame
                 
-                subprogress1.step("Finished exporting materials, now exporting skeletons/animations")
+                subprogress1.step("Now exporting animations")
 
-                # save gathered skeletons and animations
-                if self.options['EXPORT_SKEL']:
-                    log.info('now exporting skeletons')
-                    skelfile = None
-                    animfile = None
-                    try:
-                        skelfile = open(self.filepath_skel, "w", encoding="utf8", newline="\n")
-                        skelfile_write = skelfile.write
-                        skelfile_write(self.export_id_line)
+                # save gathered animations
+                if self.options['EXPORT_SKEL'] and self.options['EXPORT_ANIM']:
+                    log.info('now exporting animations')
+                    with self.open_output(self.filepath_anim) as animfile:
+                        self.write_export_id_line(animfile)
                         link_anim_basepath = None
-                        if self.options['EXPORT_ANIM']:
-                            log.info(' ... and animations')
-                            animfile = open(self.filepath_anim, "w", encoding="utf8", newline="\n")
-                            animfile_write = animfile.write
-                            animfile_write(self.export_id_line)
-                            if self.options['EXPORT_LINK_ANIM_BIN']:
-                                log.info(' ... and Link animation binaries')
-                                link_anim_basepath = self.filepath_linkbase
-                        else:
-                            animfile_write = None
-                        export_objex_anim.write_armatures(skelfile_write, animfile_write, 
-                            scene, self.options['GLOBAL_MATRIX'], self.armatures, 
-                            link_anim_basepath, self.options['LINK_BIN_SCALE'])
-                    finally:
-                        if skelfile:
-                            skelfile.close()
-                        if animfile:
-                            animfile.close()
+                        if self.options['EXPORT_LINK_ANIM_BIN']:
+                            log.info(' ... and Link animation binaries')
+                            link_anim_basepath = self.filepath_linkbase
+                        for _ in export_objex_anim.write_armatures_iter(animfile.write,
+                                scene, self.options['GLOBAL_MATRIX'], self.armatures, 
+                                link_anim_basepath, self.options['LINK_BIN_SCALE'], self.open_output,
+                                self.stats, self.binary_writer,
+                                self.index.get_recorder(animfile) if self.index else None):
+                            self.progress_done += 1
+                            yield
+                    self.log_memory_usage('animations')
                 
                 # copy all collected files.
-                bpy_extras.io_utils.path_reference_copy(copy_set)
+                with tracing.span('copy textures', count=len(copy_set)):
+                    bpy_extras.io_utils.path_reference_copy(copy_set)
+
+                if self.binary_writer:
+                    self.binary_writer.meta['materials'] = [name for name, name_q, material, face_image in self.mtl_dict.values()]
+                if self.options['EXPORT_ID'] == 'CONTENT':
+                    with tracing.span('finish_export_id'):
+                        self.finish_export_id()
+                if self.index:
+                    index_path = export_objex_index.get_index_path(filepath)
+                    with self.open_output(index_path, binary=True) as index_output:
+                        self.index.write(index_output, self.export_id)
+                if self.binary_writer:
+                    self.binary_writer.close()
+
+                for output in self.outputs:
+                    if output.compression:
+                        log.info('Wrote {:d} bytes to {} ({:d} bytes compressed)',
+                            output.bytes_written, output.filepath, output.get_file_size())
+                    else:
+                        log.info('Wrote {:d} bytes to {}', output.bytes_written, output.filepath)
+                if self.object_cache:
+                    # entries are saved by then, block_writer finished
+                    with tracing.span('prune object cache'):
+                        pruned = self.object_cache.prune()
+                    log.info('Object cache: {:d} objects reused, {:d} objects (re)built, {:d} unused entries removed in {}',
+                        self.object_cache.hits, self.object_cache.misses, pruned, self.object_cache.directory)
+                if self.options['LOW_MEMORY']:
+                    peak_rss = util.get_peak_rss()
+                    if peak_rss is not None and not self.track_phase_peak_rss:
+                        # the peak of the whole process life, including what was used before the export
+                        log.info('Process peak memory usage: {:.1f} MiB', peak_rss / (1 << 20))
+                if self.stats:
+                    stats_path = export_objex_stats.get_stats_path(filepath)
+                    # the statistics are about the exported files, not about the statistics file itself
+                    exported_outputs = list(self.outputs)
+                    # written like other outputs, so with ATOMIC_WRITE it only replaces the old statistics once complete
+                    with self.open_output(stats_path, binary=True) as stats_output:
+                        self.stats.write(stats_output, exported_outputs)
+                    log.info('Export statistics (details in {}):\n{}', stats_path, self.stats.get_summary(exported_outputs))
 
             progress.leave_substeps()
 
+        if self.options['ATOMIC_WRITE']:
+            changed_outputs = [output.filepath for output in self.outputs if output.changed]
+            unchanged_outputs = [output.filepath for output in self.outputs if not output.changed]
+            log.info('{:d} files changed:{}', len(changed_outputs),
+                ''.join('\n%s' % filepath for filepath in changed_outputs))
+            if unchanged_outputs:
+                log.info('{:d} files are unchanged and were left as they were:{}', len(unchanged_outputs),
+                    ''.join('\n%s' % filepath for filepath in unchanged_outputs))
+
 
-def save(context,
-         filepath,
+def create_writer(context,
          *,
          use_triangles=None,
          use_normals=None,
@@ -779,9 +1324,21 @@ def save(context,
          use_collection=None,
          include_armatures_from_selection=True,
          global_matrix=None,
-         path_mode=None
+         path_mode=None,
+         output_chunk_size=None,
+         format_processes=None,
+         use_object_cache=None,
+         low_memory=None,
+         background_write=None,
+         use_trace=None,
+         use_stats=None,
+         binary_container=None,
+         compression=None,
+         atomic_write=None,
+         export_id=None,
+         use_index=None
          ):
-
+    """Return an ObjexWriter set up to export the objects selected by the arguments, see save"""
     objex_writer = ObjexWriter(context)
     objex_writer.set_options({
         'TRIANGULATE':use_triangles,
@@ -804,7 +1361,19 @@ def save(context,
         'EXPORT_PACKED_IMAGES':export_packed_images,
         'EXPORT_PACKED_IMAGES_DIR':export_packed_images_dir,
         'GLOBAL_MATRIX':global_matrix,
-        'PATH_MODE':path_mode
+        'PATH_MODE':path_mode,
+        'OUTPUT_CHUNK_SIZE':output_chunk_size,
+        'FORMAT_PROCESSES':format_processes,
+        'OBJECT_CACHE':use_object_cache,
+        'LOW_MEMORY':low_memory,
+        'BACKGROUND_WRITE':background_write,
+        'TRACE':use_trace,
+        'STATS':use_stats,
+        'BINARY_CONTAINER':binary_container,
+        'COMPRESSION':compression,
+        'ATOMIC_WRITE':atomic_write,
+        'EXPORT_ID':export_id,
+        'INDEX':use_index,
     })
     
     # Exit edit mode before exporting, so current object states are exported properly.
@@ -825,7 +1394,10 @@ def save(context,
         objects = context.scene.objects
     objex_writer.add_target_objects(objects)
 
+    return objex_writer
+
+def save(context, filepath, **kwargs):
     # EXPORT THE FILE.
-    objex_writer.write(filepath)
+    create_writer(context, **kwargs).write(filepath)
     
     return {'FINISHED'}
@@ -20,10 +20,11 @@ import mathutils
 import math
 
 from . import util
+from . import tracing
 from .logging_util import getLogger
 
 
-def write_skeleton(file_write_skel, global_matrix, object_transform, armature, armature_name_q, bones_ordered):
+def write_skeleton(file_write_skel, global_matrix, object_transform, armature, armature_name_q, bones_ordered, binary_writer=None):
     log = getLogger('anim')
     fw = file_write_skel
     objex_data = armature.data.objex_bonus
@@ -48,6 +49,7 @@ def write_skeleton(file_write_skel, global_matrix, object_transform, armature, a
         fw('\n')
     indent = 0
     stack = [None]
+    bone_positions = []
     transform = blender_version_compatibility.matmul(global_matrix, object_transform)
     for bone in bones_ordered:
         #print('indent=%d bone=%s parent=%s stack=%r' % (indent, bone.name, bone.parent.name if bone.parent else 'None', stack))
@@ -63,12 +65,17 @@ def write_skeleton(file_write_skel, global_matrix, object_transform, armature, a
             if bone.head_local != mathutils.Vector((0,0,0)):
                 log.debug('root bone {} at {!r} does not start at armature origin', bone.name, pos)
         fw('%s+ %s %.6f %.6f %.6f\n' % (' ' * indent, util.quote(bone.name), pos.x, pos.y, pos.z))
+        bone_positions.append(pos[:])
         indent += 1
         stack.append(bone)
     while indent > 0:
         indent -= 1
         fw('%s-\n' % (' ' * indent))
     fw('\n')
+    if binary_writer:
+        bone_indices = {bone.name: i for i, bone in enumerate(bones_ordered)}
+        binary_writer.add_skeleton(armature.name, [bone.name for bone in bones_ordered],
+            [bone_indices[bone.parent.name] if bone.parent else -1 for bone in bones_ordered], bone_positions)
 
 def order_bones(armature):
     log = getLogger('anim')
@@ -108,7 +115,33 @@ def order_bones(armature):
     
     return root_bone, bones_ordered
 
-def write_armatures(file_write_skel, file_write_anim, scene, global_matrix, armatures, link_anim_basepath, link_bin_scale):
+def get_action_frame_count(action):
+    frame_start, frame_end = action.frame_range
+    return int(frame_end - frame_start + 1)
+
+def write_armature_skeleton(file_write_skel, global_matrix, object_transform, armature, armature_name_q, binary_writer=None, index_skel=None):
+    """
+    Write the skeleton of armature, see write_skeleton
+    index_skel: a function adding the newskel record to the index (see ExportIndex.get_recorder), or None
+    """
+    log = getLogger('anim')
+    root_bone, bones_ordered = order_bones(armature)
+    if not bones_ordered:
+        # 421todo abort?
+        log.error('armature {} has no bones', armature.name)
+    if index_skel:
+        index_skel('newskel', armature.name)
+    with tracing.span('write_skeleton', armature=armature.name):
+        write_skeleton(file_write_skel, global_matrix, object_transform, armature, armature_name_q, bones_ordered, binary_writer)
+
+def write_armatures_iter(file_write_anim, scene, global_matrix, armatures, link_anim_basepath, link_bin_scale, open_output, stats=None, binary_writer=None, index_anim=None):
+    """
+    Generator writing animations (skeletons are written by write_armature_skeleton), yields after each animation frame written.
+    The user frame and actions are restored when it is exhausted or closed early.
+    stats: an ExportStats (see export_objex_stats) to add the exported actions to, or None
+    binary_writer: a ContainerWriter (see export_objex_binary) to also add animations to, or None
+    index_anim: a function adding newanim records to the index (see ExportIndex.get_recorder), or None
+    """
     log = getLogger('anim')
 
     # user_ variables store parameters (potentially) used by the script and to be restored later
@@ -120,39 +153,34 @@ def write_armatures(file_write_skel, file_write_anim, scene, global_matrix, arma
     if scene_fps != 20 and any(armature_actions for _0, _1, _2, armature_actions in armatures):
         log.warning('animations are being viewed at {:.1f} fps (change this in render settings), but will be used at 20 fps', scene_fps)
 
-    # armatures is built in ObjexWriter#write_object in export_objex.py (look for self.armatures)
-    for armature_name_q, armature, object_transform, armature_actions in armatures:
-        if armature.animation_data:
-            user_armature_action = armature.animation_data.action
-        
-        root_bone, bones_ordered = order_bones(armature)
-        
-        if not bones_ordered:
-            # 421todo abort?
-            log.error('armature {} has no bones', armature.name)
-        
-        if file_write_skel:
-            write_skeleton(file_write_skel, global_matrix, object_transform, armature, armature_name_q, bones_ordered)
-        
-        if file_write_anim and armature_actions:
+    try:
+        # armatures is built in ObjexWriter#write_object in export_objex.py (look for self.armatures)
+        for armature_name_q, armature, object_transform, armature_actions in armatures:
             if armature.animation_data:
-                write_animations(file_write_anim, scene, global_matrix, object_transform, armature, armature_name_q, root_bone, bones_ordered, armature_actions, link_anim_basepath, link_bin_scale)
-            else:
-                log.warning(
-                    'Skipped exporting actions {!r} with armature {},\n'
-                    'because the armature did not have animation_data\n'
-                    '(consider unchecking "Export all actions" under Objex armature properties;\n'
-                    'if you do want actions to be exported with this armature,\n'
-                    'animation_data can be initialized by creating a dummy action by adding a keyframe in pose mode)'
-                    , armature_actions, armature.name
-                )
-        
-        if armature.animation_data:
-            armature.animation_data.action = user_armature_action
-    
-    scene.frame_set(user_frame_current, subframe=user_frame_subframe)
+                user_armature_action = armature.animation_data.action
+            
+            root_bone, bones_ordered = order_bones(armature)
+            
+            try:
+                if file_write_anim and armature_actions:
+                    if armature.animation_data:
+                        yield from write_animations_iter(file_write_anim, scene, global_matrix, object_transform, armature, armature_name_q, root_bone, bones_ordered, armature_actions, link_anim_basepath, link_bin_scale, open_output, stats, binary_writer, index_anim)
+                    else:
+                        log.warning(
+                            'Skipped exporting actions {!r} with armature {},\n'
+                            'because the armature did not have animation_data\n'
+                            '(consider unchecking "Export all actions" under Objex armature properties;\n'
+                            'if you do want actions to be exported with this armature,\n'
+                            'animation_data can be initialized by creating a dummy action by adding a keyframe in pose mode)'
+                            , armature_actions, armature.name
+                        )
+            finally:
+                if armature.animation_data:
+                    armature.animation_data.action = user_armature_action
+    finally:
+        scene.frame_set(user_frame_current, subframe=user_frame_subframe)
 
-def write_animations(file_write_anim, scene, global_matrix, object_transform, armature, armature_name_q, root_bone, bones_ordered, actions, link_anim_basepath, link_bin_scale):
+def write_animations_iter(file_write_anim, scene, global_matrix, object_transform, armature, armature_name_q, root_bone, bones_ordered, actions, link_anim_basepath, link_bin_scale, open_output, stats, binary_writer, index_anim):
     log = getLogger('anim')
     fw = file_write_anim
     fw('# %s\n' % armature.name)
@@ -162,17 +190,21 @@ def write_animations(file_write_anim, scene, global_matrix, object_transform, ar
         link_anim_basepath = None
 
     for action in actions:
-        frame_start, frame_end = action.frame_range
-        frame_count = int(frame_end - frame_start + 1)
+        frame_start = action.frame_range[0]
+        frame_count = get_action_frame_count(action)
+        if index_anim:
+            index_anim('newanim', action.name, armature=armature.name)
         fw('newanim %s %s %d\n' % (armature_name_q, util.quote(action.name), frame_count))
+        if stats:
+            stats.add_action(armature.name, action.name, frame_count, len(bones_ordered))
 
         link_anim_file = None
         if link_anim_basepath is not None:
             link_anim_filename = link_anim_basepath + ''.join(c for c in action.name if c.isalnum()) + '_' + str(frame_count) + '.bin'
-            link_anim_file = open(link_anim_filename, 'wb')
+            link_anim_file = open_output(link_anim_filename, binary=True)
 
         try:
-            write_action(fw, scene, global_matrix, object_transform, armature, root_bone, bones_ordered, action, frame_start, frame_count, link_anim_file, link_bin_scale)
+            yield from write_action_iter(fw, scene, global_matrix, object_transform, armature, root_bone, bones_ordered, action, frame_start, frame_count, link_anim_file, link_bin_scale, binary_writer)
         finally:
             if link_anim_file is not None:
                 link_anim_file.close()
@@ -181,7 +213,7 @@ def write_animations(file_write_anim, scene, global_matrix, object_transform, ar
 
     fw('\n')
 
-def write_action(fw, scene, global_matrix, object_transform, armature, root_bone, bones_ordered, action, frame_start, frame_count, link_anim_file, link_bin_scale):
+def write_action_iter(fw, scene, global_matrix, object_transform, armature, root_bone, bones_ordered, action, frame_start, frame_count, link_anim_file, link_bin_scale, binary_writer=None):
     log = getLogger('anim')
     transform = blender_version_compatibility.matmul(global_matrix, object_transform)
     transform3 = transform.to_3x3()
@@ -210,8 +242,13 @@ def write_action(fw, scene, global_matrix, object_transform, armature, root_bone
         if child.location != mathutils.Vector((0,0,0)):
             log.debug('origin of object {} {!r} (parent armature {}) is not world origin (0,0,0)', child.name, child.location, armature.name)
 
+    # root location and bone rotations of each frame, for binary_writer
+    locations = []
+    rotations = []
     for frame_current_offset in range(frame_count):
         frame_current = frame_start + frame_current_offset
+        # not a with block, to not hold the span open while the generator is suspended
+        frame_span = tracing.span('write_action frame', action=action.name, frame=frame_current)
         scene.frame_set(frame_current)
         # 421todo what if root_bone.head != 0
         """
@@ -228,6 +265,7 @@ def write_action(fw, scene, global_matrix, object_transform, armature, root_bone
         root_loc = root_pose_bone.head # armature space
         root_loc = blender_version_compatibility.matmul(transform, root_loc)
         fw('loc %.6f %.6f %.6f\n' % (root_loc.x, root_loc.y, root_loc.z)) # 421todo what about "ms"
+        locations.append(root_loc[:])
         if link_anim_file is not None:
             x = int(root_loc.x * link_bin_scale)
             y = int(root_loc.y * link_bin_scale)
@@ -267,6 +305,7 @@ def write_action(fw, scene, global_matrix, object_transform, armature, root_bone
             rotation_euler_zyx = rot_matrix.to_euler('XYZ')
             # 5 digits: precision of s16 angles in radians is 2pi/2^16 ~ ‭0.000096
             fw('rot %.5f %.5f %.5f\n' % (rotation_euler_zyx.x, rotation_euler_zyx.y, rotation_euler_zyx.z))
+            rotations.append(rotation_euler_zyx[:])
             if link_anim_file is not None:
                 def rad_to_shortang(r):
                     r *= 0x8000 / math.pi
@@ -293,3 +332,9 @@ def write_action(fw, scene, global_matrix, object_transform, armature, root_bone
                         i = -1
                 texanimvalue |= (i+1) << 4
             link_anim_file.write(texanimvalue.to_bytes(2, byteorder='big'))
+
+        frame_span.end()
+        yield
+
+    if binary_writer:
+        binary_writer.add_animation(armature.name, action.name, locations, rotations, len(bones_ordered))
@@ -0,0 +1,169 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Writer of binary objex containers (.objexbin), see objex_binary for the format and the reader
+"""
+
+import json
+import os
+
+import numpy as np
+
+from . import objex_binary
+
+# format character: numpy dtype
+DTYPES = {
+    'i': '<i4',
+    'f': '<f4',
+}
+
+
+def get_container_path(filepath):
+    return os.path.splitext(filepath)[0] + '.objexbin'
+
+class ContainerWriter():
+    """
+    Write sections to sink (a binary OutputSink) as they are added, and the table describing them when closing.
+    meta is:
+    {
+        "header": leading .objex directives, only if the text .objex isn't written
+        "objects": [{
+            "name", "header" (directives before the data: g, attrib...),
+            "offsets" (1-based v/vt/vn/vc index of the first item of the object, like in .objex),
+            "v", "vt", "vn", "vc" (section names, vt/vn/vc can be null),
+            "weights": null or {"offsets", "bones", "weights" (section names), "bone_names" (quoted like in .objex), "unique"},
+                (the weights of vertex i are weights[offsets[i]:offsets[i+1]] for bones[offsets[i]:offsets[i+1]])
+            "corners" (section of the object-local 0-based v[/vt][/vn][/vc] indices of each face corner),
+            "face_sizes" (section of the corner count of each face),
+            "runs" (section of face start, face end of each run of faces), "run_directives" (usemtl/s directives of each run)
+        }],
+        "materials": [material names, as defined in .mtlex],
+        "skeletons": [{"name", "bone_names", "bone_parents" (index of the parent bone or -1), "bone_positions" (section)}],
+        "animations": [{"armature", "action", "locations" (section, root location per frame),
+                        "rotations" (section, XYZ euler angles per frame per bone)}],
+    }
+    """
+    def __init__(self, sink):
+        self.sink = sink
+        self.offset = 0
+        self.sections = {}
+        self.meta = {
+            'header': None,
+            'objects': [],
+            'materials': [],
+            'skeletons': [],
+            'animations': [],
+        }
+        self.write(objex_binary.HEADER.pack(objex_binary.MAGIC, objex_binary.VERSION, 0))
+
+    def write(self, data):
+        self.sink.write(data)
+        self.offset += len(data)
+
+    def add_section(self, name, array, format):
+        """Write array as a new section (converting it to format), return name"""
+        if name in self.sections:
+            raise ValueError('Duplicate section %r' % name)
+        array = np.ascontiguousarray(array, dtype=DTYPES[format])
+        padding = -self.offset % objex_binary.ALIGNMENT
+        if padding:
+            self.write(bytes(padding))
+        self.sections[name] = {
+            'offset': self.offset,
+            'format': format,
+            'shape': list(array.shape),
+        }
+        self.write(array.tobytes())
+        return name
+
+    def add_mesh_block(self, name, block, offsets):
+        """Add an object from its MeshBlock (with a MeshData, not formatted) and the offsets it is written at"""
+        prefix = 'objects/%d/' % len(self.meta['objects'])
+        data = block.data
+        obj = {
+            'name': name,
+            'header': block.header,
+            'offsets': list(offsets),
+            'v': self.add_section(prefix + 'v', data.vertex_positions, 'f'),
+            'vt': None if data.uvs is None else self.add_section(prefix + 'vt', data.uvs, 'f'),
+            'vn': None if data.normals is None else self.add_section(prefix + 'vn', data.normals, 'f'),
+            'vc': None if data.vertex_colors is None else self.add_section(prefix + 'vc', data.vertex_colors, 'f'),
+            'weights': None,
+            'corners': self.add_section(prefix + 'corners', block.corner_indices, 'i'),
+            'face_sizes': self.add_section(prefix + 'face_sizes', block.face_sizes, 'i'),
+            'runs': self.add_section(prefix + 'runs',
+                np.array([(start, end) for start, end, directives in block.runs], dtype=np.int64).reshape(-1, 2), 'i'),
+            'run_directives': [directives for start, end, directives in block.runs],
+        }
+        weights = data.vertex_weights
+        if weights is not None:
+            obj['weights'] = {
+                'offsets': self.add_section(prefix + 'weights/offsets', weights.offsets, 'i'),
+                'bones': self.add_section(prefix + 'weights/bones', weights.bone_indices, 'i'),
+                'weights': self.add_section(prefix + 'weights/weights', weights.weights, 'f'),
+                'bone_names': weights.bone_names_q,
+                'unique': data.unique_weights,
+            }
+        self.meta['objects'].append(obj)
+
+    def add_skeleton(self, name, bone_names, bone_parents, bone_positions):
+        prefix = 'skeletons/%d/' % len(self.meta['skeletons'])
+        self.meta['skeletons'].append({
+            'name': name,
+            'bone_names': bone_names,
+            'bone_parents': bone_parents,
+            'bone_positions': self.add_section(prefix + 'bone_positions',
+                np.asarray(bone_positions, dtype=np.float64).reshape(-1, 3), 'f'),
+        })
+
+    def add_animation(self, armature_name, action_name, locations, rotations, bone_count):
+        prefix = 'animations/%d/' % len(self.meta['animations'])
+        self.meta['animations'].append({
+            'armature': armature_name,
+            'action': action_name,
+            'locations': self.add_section(prefix + 'locations',
+                np.asarray(locations, dtype=np.float64).reshape(-1, 3), 'f'),
+            'rotations': self.add_section(prefix + 'rotations',
+                np.asarray(rotations, dtype=np.float64).reshape(-1, bone_count, 3), 'f'),
+        })
+
+    def get_table(self):
+        """Return the table (encoded) as it would be written now"""
+        return json.dumps({'sections': self.sections, 'meta': self.meta}).encode('utf8')
+
+    def close(self, complete=True):
+        """
+        Write the table and close sink, does nothing if already closed
+        With complete=False (failed export) the table isn't written, so the file can't be mistaken for a complete container
+        """
+        if self.sink is None:
+            return
+        sink = self.sink
+        try:
+            if complete:
+                table = self.get_table()
+                table_offset = self.offset
+                self.write(table)
+                self.write(objex_binary.FOOTER.pack(table_offset, len(table)))
+        finally:
+            self.sink = None
+            sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(complete=exc_type is None)
@@ -0,0 +1,117 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Persistent cache of the parts of objects blocks that are expensive to build and don't depend on index offsets:
+the formatted v/vt/vn/vc directives and the (object-local) indices of each face corner.
+
+Entries are .npz files named after a hash of everything the cached data is computed from.
+Entries not used by an export are removed once it succeeded (see ObjectCache.prune), so the cache only
+holds the objects of the last export.
+This module doesn't use bpy, entries can be saved from worker processes.
+"""
+
+import hashlib
+import os
+
+import numpy as np
+
+# change this when the cached data or the way it is computed changes, to ignore older entries
+CACHE_VERSION = 1
+
+
+def get_cache_directory(filepath):
+    """Return the cache directory used when exporting to filepath, next to it"""
+    return os.path.splitext(filepath)[0] + '_objex_cache'
+
+class ObjectCache():
+    def __init__(self, directory):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        # keys loaded (or missing, and saved) during this export
+        self.used_keys = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def get_key(self, arrays, values):
+        """
+        Return the key (hex digest) for data computed from arrays (numpy arrays, or None) and values (anything with a stable repr)
+        """
+        hasher = hashlib.sha1()
+        hasher.update(repr((CACHE_VERSION, values)).encode('utf8'))
+        for array in arrays:
+            if array is None:
+                hasher.update(b'None')
+                continue
+            array = np.ascontiguousarray(array)
+            hasher.update(repr((array.dtype.str, array.shape)).encode('utf8'))
+            hasher.update(array.tobytes())
+        return hasher.hexdigest()
+
+    def get_path(self, key):
+        return os.path.join(self.directory, '%s.npz' % key)
+
+    def load(self, key):
+        """Return (text, counts, columns, corner_indices) as saved by save_entry, or None if key isn't cached"""
+        self.used_keys.add(key)
+        path = self.get_path(key)
+        try:
+            with np.load(path) as entry:
+                text = entry['text'].tobytes().decode('utf8')
+                counts = tuple(entry['counts'].tolist())
+                columns = tuple(entry['columns'].tolist())
+                corner_indices = entry['corner_indices']
+        except (OSError, KeyError, ValueError):
+            # missing, or unreadable (which is treated as missing, the entry will be overwritten)
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text, counts, columns, corner_indices
+
+    def prune(self):
+        """
+        Remove the entries not used by this export, and temporary files left by interrupted exports
+        Return the amount of files removed
+        """
+        removed = 0
+        for name in os.listdir(self.directory):
+            key, ext = os.path.splitext(name)
+            if (ext == '.npz' and key not in self.used_keys) or ext == '.tmp':
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    # the next export will try again
+                    continue
+                removed += 1
+        return removed
+
+def save_entry(path, text, counts, columns, corner_indices):
+    """
+    Save an entry for ObjectCache.load
+    text: the formatted v/vt/vn/vc directives
+    counts: the amount of (v, vt, vn, vc) directives in text
+    columns: (has uvs, has normals, has vertex colors)
+    corner_indices: (corner count, fields) object-local indices
+    """
+    # write to a temporary file first so an interrupted export doesn't leave a truncated entry
+    temp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.savez(f,
+            text=np.frombuffer(text.encode('utf8'), dtype=np.uint8),
+            counts=np.array(counts, dtype=np.int64),
+            columns=np.array(columns, dtype=bool),
+            corner_indices=corner_indices,
+        )
+    os.replace(temp_path, path)
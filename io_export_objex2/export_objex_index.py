@@ -0,0 +1,88 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Index of the records (g, newmtl, newtex, newskel, newanim) of exported text files, written as a JSON sidecar
+so tools can seek directly to a record instead of parsing whole files
+"""
+
+import functools
+import json
+import os
+
+
+def get_index_path(filepath):
+    """Return the path of the index written when exporting to filepath, next to it"""
+    return os.path.splitext(filepath)[0] + '_index.json'
+
+class ExportIndex():
+    """
+    Records are added as they are written, at the current offset of the OutputSink they are written to.
+    The index is:
+    {
+        "exportid": the exportid written to the files,
+        "files": {file name: {"bytes" (uncompressed size), "records": [{
+            "directive", "name" (not quoted), "offset", "length",
+            "armature" (newanim only), "base" (g only, 1-based index of the first v/vt/vn/vc of the group)
+        }]}}
+    }
+    Offsets and lengths are in bytes of the uncompressed text (of the decompressed stream with compression).
+    A record extends to the next record of the file, or to the end of the records (see end_records) or of the file.
+    """
+    def __init__(self):
+        # [(OutputSink, records)] in the order files were first indexed
+        self.files = []
+        # {OutputSink: records}
+        self._records = {}
+        # {OutputSink: offset} where the last record of a file ends, if not at the end of the file
+        self._records_end = {}
+
+    def add_record(self, sink, directive, name, **fields):
+        """Add a record starting at the current offset of sink, fields are added to the record as-is"""
+        records = self._records.get(sink)
+        if records is None:
+            records = self._records[sink] = []
+            self.files.append((sink, records))
+        record = {'directive': directive, 'name': name, 'offset': sink.tell()}
+        record.update(fields)
+        records.append(record)
+
+    def end_records(self, sink):
+        """End the last record of sink at its current offset, for text written after it which isn't part of it"""
+        self._records_end[sink] = sink.tell()
+
+    def get_recorder(self, sink):
+        """Return a function adding records to sink, see add_record"""
+        return functools.partial(self.add_record, sink)
+
+    def get_index(self, export_id):
+        """Return the index, once all indexed files are closed"""
+        files = {}
+        for sink, records in self.files:
+            ends = [record['offset'] for record in records[1:]] + [self._records_end.get(sink, sink.bytes_written)]
+            for record, end in zip(records, ends):
+                record['length'] = end - record['offset']
+            files[os.path.basename(sink.filepath)] = {
+                'bytes': sink.bytes_written,
+                'records': records,
+            }
+        return {
+            'exportid': export_id,
+            'files': files,
+        }
+
+    def write(self, sink, export_id):
+        """Write the index to sink, a binary OutputSink"""
+        sink.write(json.dumps(self.get_index(export_id)).encode('utf8'))
@@ -0,0 +1,568 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Bulk (array based) helpers for reading mesh data and formatting it into objex directives.
+
+Mesh data is read with foreach_get into numpy arrays instead of going through
+one Python wrapper per vertex/loop, which is what dominates export time on dense meshes.
+numpy is bundled with Blender.
+"""
+
+import collections
+import time
+
+import numpy as np
+
+from . import export_objex_cache
+from . import tracing
+
+# how many rows to format at once when writing arrays,
+# keeps the temporary strings small on huge meshes
+FORMAT_CHUNK_ROWS = 4096
+
+
+def matrix_to_array(matrix):
+    """Convert a mathutils.Matrix to a float64 numpy array (rows are kept as rows)"""
+    return np.array([tuple(row) for row in matrix], dtype=np.float64)
+
+def is_uniform_scale(matrix, tolerance=1e-6):
+    """
+    Check if the 3x3 part of matrix is a rotation (possibly mirrored) with a uniform scale.
+    Angles (and thus auto smooth and normals in general) are preserved by such transforms.
+    """
+    m = matrix_to_array(matrix)[:3,:3]
+    mmt = m.dot(m.T)
+    scale2 = mmt.trace() / 3
+    if scale2 == 0:
+        return False
+    return np.allclose(mmt / scale2, np.identity(3), rtol=0, atol=tolerance)
+
+def get_vertex_positions(mesh):
+    """Return the positions of mesh vertices as a (vertex count, 3) float32 array"""
+    count = len(mesh.vertices)
+    co = np.empty(count * 3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', co)
+    return co.reshape((count, 3))
+
+def transform_points(co, matrix):
+    """
+    Apply the 4x4 matrix to all points of co (a (n, 3) array) at once.
+    The result is float32, like the coordinates Mesh.transform would have stored.
+    """
+    m = matrix_to_array(matrix)
+    return (co.dot(m[:3,:3].T) + m[:3,3]).astype(np.float32)
+
+def write_rows(fw, line_format, rows):
+    """
+    Write one line_format-formatted line per row of the 2d array rows.
+    Formatting is done with a single % operation for FORMAT_CHUNK_ROWS rows at once.
+    """
+    rows = np.asarray(rows)
+    for start in range(0, len(rows), FORMAT_CHUNK_ROWS):
+        chunk = rows[start:start+FORMAT_CHUNK_ROWS]
+        # tolist() gives python floats/ints, the same values that would be read from the mesh directly
+        fw((line_format * len(chunk)) % tuple(chunk.ravel().tolist()))
+
+def get_loop_vertex_indices(mesh):
+    """Return the vertex index of each loop as an int32 array"""
+    loop_vertex_indices = np.empty(len(mesh.loops), dtype=np.int32)
+    mesh.loops.foreach_get('vertex_index', loop_vertex_indices)
+    return loop_vertex_indices
+
+def get_polygon_loop_ranges(mesh):
+    """Return (loop_starts, loop_totals) int32 arrays, describing the loops of each polygon"""
+    count = len(mesh.polygons)
+    loop_starts = np.empty(count, dtype=np.int32)
+    loop_totals = np.empty(count, dtype=np.int32)
+    mesh.polygons.foreach_get('loop_start', loop_starts)
+    mesh.polygons.foreach_get('loop_total', loop_totals)
+    return loop_starts, loop_totals
+
+def get_corner_loops(loop_starts, loop_totals, polygon_order):
+    """
+    Return the loop indices of the polygons in polygon_order, concatenated.
+    This is the order loops are visited in when writing faces.
+    """
+    polygon_order = np.asarray(polygon_order, dtype=np.int64)
+    starts = loop_starts[polygon_order].astype(np.int64)
+    totals = loop_totals[polygon_order].astype(np.int64)
+    # corner k of the i-th polygon is at position (sum of totals before i) + k,
+    # and its loop index is starts[i] + k
+    offsets = starts - (np.cumsum(totals) - totals)
+    return np.repeat(offsets, totals) + np.arange(totals.sum(), dtype=np.int64)
+
+def get_loop_uvs(uv_layer):
+    """Return the uv of each loop in uv_layer (a MeshUVLoopLayer) as a (loop count, 2) float32 array"""
+    count = len(uv_layer.data)
+    uvs = np.empty(count * 2, dtype=np.float32)
+    uv_layer.data.foreach_get('uv', uvs)
+    return uvs.reshape((count, 2))
+
+def unique_rows(keys):
+    """
+    Deduplicate the rows of the 2d array keys.
+    Unique rows are numbered by order of first occurrence (like a dict filled while iterating keys would).
+    Return (first, inverse) where first[i] is the index in keys of the first occurrence of unique row i,
+    and inverse[j] is the unique row index of keys[j].
+    """
+    keys = np.ascontiguousarray(keys)
+    if not len(keys):
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    _, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    # np.unique sorts the rows, renumber them by first occurrence
+    order = np.argsort(first, kind='mergesort')
+    rank = np.empty_like(order)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse]
+
+def quantize(values, digits):
+    """Round values to digits decimal digits, as int64 (values * 10**digits)"""
+    return np.rint(np.asarray(values, dtype=np.float64) * (10 ** digits)).astype(np.int64)
+
+def get_loop_normals(mesh):
+    """
+    Return the (split) normal of each loop as a (loop count, 3) float32 array.
+    Before Blender 4.1, Mesh.calc_normals_split must have been called first.
+    """
+    count = len(mesh.loops)
+    normals = np.empty(count * 3, dtype=np.float32)
+    if hasattr(mesh, 'corner_normals'): # 4.1+
+        mesh.corner_normals.foreach_get('vector', normals)
+    else: # < 4.1
+        mesh.loops.foreach_get('normal', normals)
+    return normals.reshape((count, 3))
+
+def transform_normals(normals, normal_matrix):
+    """Apply the 3x3 normal_matrix to all normals at once, and normalize the result"""
+    normals = np.asarray(normals, dtype=np.float64).dot(matrix_to_array(normal_matrix).T)
+    lengths = np.sqrt((normals * normals).sum(axis=1))
+    lengths[lengths == 0] = 1
+    return normals / lengths[:,np.newaxis]
+
+def get_active_color_attribute(mesh):
+    """Return the active color attribute of mesh, or None (always None before Blender 3.2)"""
+    if not hasattr(mesh, 'color_attributes'): # < 3.2
+        return None
+    color_attribute = getattr(mesh.color_attributes, 'active_color', None)
+    if color_attribute is None:
+        color_attribute = mesh.attributes.active_color
+    return color_attribute
+
+def _get_colors(data, attr):
+    """Read attr of all elements of data as a (len(data), 4) float32 array, padding alpha to 1 if needed"""
+    count = len(data)
+    if not count:
+        return np.empty((0, 4), dtype=np.float32)
+    size = len(getattr(data[0], attr)) # 3 (< 2.80) or 4
+    colors = np.empty(count * size, dtype=np.float32)
+    data.foreach_get(attr, colors)
+    colors = colors.reshape((count, size))
+    if size == 3:
+        # default to alpha = 1 (opaque)
+        colors = np.column_stack((colors, np.ones(count, dtype=np.float32)))
+    return colors
+
+def get_loop_colors(mesh, loop_vertex_indices):
+    """
+    Return the color (RGBA) of each loop from the active color layer, as a (loop count, 4) float32 array,
+    or None if the mesh has no color layer.
+    Colors are read as stored in vertex color layers (sRGB), both corner and point domain color attributes are supported.
+    """
+    color_attribute = get_active_color_attribute(mesh)
+    if (color_attribute is not None and len(color_attribute.data)
+        and hasattr(color_attribute.data[0], 'color_srgb') # 3.4+
+    ):
+        colors = _get_colors(color_attribute.data, 'color_srgb')
+        if color_attribute.domain == 'POINT':
+            colors = colors[loop_vertex_indices]
+        return colors
+    # 421todo allow choosing a layer
+    if hasattr(mesh, 'vertex_colors') and len(mesh.vertex_colors):
+        return _get_colors(mesh.vertex_colors.active.data, 'color')
+    if color_attribute is not None: # 3.2, 3.3 (float or point domain colors, not in vertex_colors)
+        colors = _get_colors(color_attribute.data, 'color')
+        if color_attribute.domain == 'POINT':
+            colors = colors[loop_vertex_indices]
+        return colors
+    return None
+
+def get_polygon_material_indices(mesh):
+    """Return the material index of each polygon as an int32 array"""
+    material_indices = np.empty(len(mesh.polygons), dtype=np.int32)
+    mesh.polygons.foreach_get('material_index', material_indices)
+    return material_indices
+
+def get_polygon_use_smooth(mesh):
+    """Return the use_smooth flag of each polygon as a bool array"""
+    use_smooth = np.empty(len(mesh.polygons), dtype=bool)
+    mesh.polygons.foreach_get('use_smooth', use_smooth)
+    return use_smooth
+
+def get_run_starts(*face_keys):
+    """
+    face_keys are arrays with one value per face.
+    Return the indices of the faces where any of these values changes from the previous face
+    (the first face always starts a run).
+    """
+    count = len(face_keys[0])
+    changes = np.zeros(count, dtype=bool)
+    if count:
+        changes[0] = True
+    for keys in face_keys:
+        keys = np.asarray(keys)
+        changes[1:] |= keys[1:] != keys[:-1]
+    return np.flatnonzero(changes)
+
+def get_corner_format(has_uvs, has_normals, has_vertex_colors):
+    """Return the format of a face corner, v[/vt[/vn[/vc]]] coordinates/uv/normal/color"""
+    fields = ['%d', '%d' if has_uvs else '', '%d' if has_normals else '', '%d' if has_vertex_colors else '']
+    while not fields[-1]:
+        fields.pop()
+    return '/'.join(fields)
+
+def write_faces(fw, corner_format, corner_indices, face_sizes):
+    """
+    Write f directives.
+    corner_indices is a (corner count, fields) int array, with the (global) indices of each corner of each face,
+    fields being the number of %d in corner_format.
+    face_sizes is the number of corners of each face.
+    Faces of the same size following each other are formatted together.
+    """
+    face_sizes = np.asarray(face_sizes)
+    if not len(face_sizes):
+        return
+    corner_offsets = np.concatenate(([0], np.cumsum(face_sizes)))
+    size_run_starts = get_run_starts(face_sizes).tolist()
+    for start, end in zip(size_run_starts, size_run_starts[1:] + [len(face_sizes)]):
+        size = int(face_sizes[start])
+        rows = corner_indices[corner_offsets[start]:corner_offsets[end]].reshape((end - start, -1))
+        write_rows(fw, 'f%s\n' % ((' %s' % corner_format) * size), rows)
+
+class VertexWeights():
+    """
+    Compressed sparse row table of vertex weights.
+    The weights of vertex i are weights[offsets[i]:offsets[i+1]],
+    for the bones bone_indices[offsets[i]:offsets[i+1]] (indices in bone_names_q).
+    """
+    def __init__(self, offsets, bone_indices, weights, bone_names_q):
+        self.offsets = offsets
+        self.bone_indices = bone_indices
+        self.weights = weights
+        self.bone_names_q = bone_names_q
+
+    def get_entry_vertices(self):
+        """Return the vertex index of each entry"""
+        return np.repeat(np.arange(len(self.offsets) - 1), np.diff(self.offsets))
+
+def get_vertex_weights(mesh, vertex_group_names, bone_names, quote):
+    """
+    Gather the weights of mesh vertices into a VertexWeights table.
+    Only vertex groups named after a bone (in bone_names) are kept,
+    quote is used once per bone name to build bone_names_q.
+    """
+    bone_indices_by_name = {bone_name: i for i, bone_name in enumerate(bone_names)}
+    # vertex group index -> bone index, or -1
+    group_to_bone = np.array([bone_indices_by_name.get(name, -1) for name in vertex_group_names] + [-1], dtype=np.int64)
+    # reading vertex groups can't be done with foreach_get, keep the python loop as tight as possible
+    counts = []
+    groups = []
+    weights = []
+    for vertex_vertex_groups in [v.groups for v in mesh.vertices]:
+        counts.append(len(vertex_vertex_groups))
+        for g in vertex_vertex_groups:
+            groups.append(g.group)
+            weights.append(g.weight)
+    groups = np.array(groups, dtype=np.int64)
+    weights = np.array(weights, dtype=np.float32)
+    # (invalid group indices use the last, -1, entry of group_to_bone)
+    groups[(groups < 0) | (groups >= len(vertex_group_names))] = len(vertex_group_names)
+    bone_indices = group_to_bone[groups]
+    # drop entries of vertex groups not named after a bone
+    keep = bone_indices >= 0
+    entry_vertices = np.repeat(np.arange(len(counts)), np.array(counts, dtype=np.int64))
+    counts = np.bincount(entry_vertices[keep], minlength=len(counts))
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    return VertexWeights(offsets, bone_indices[keep], weights[keep], [quote(bone_name) for bone_name in bone_names])
+
+def format_unique_weights(vertex_weights):
+    """
+    Return for each vertex the weight directive for its group of maximum weight (with weight 1),
+    or '' if the vertex has no weight
+    """
+    offsets = vertex_weights.offsets
+    weights = vertex_weights.weights
+    vertex_count = len(offsets) - 1
+    entry_bones = [-1] * vertex_count
+    if len(weights):
+        counts = np.diff(offsets)
+        nonempty = counts > 0
+        vertex_max = np.zeros(vertex_count, dtype=weights.dtype)
+        vertex_max[nonempty] = np.maximum.reduceat(weights, offsets[:-1][nonempty])
+        entry_vertices = vertex_weights.get_entry_vertices()
+        max_entries = np.flatnonzero(weights == vertex_max[entry_vertices])
+        # first entry of maximum weight for each vertex (like max() would pick)
+        first_max_entry = np.full(vertex_count, -1, dtype=np.int64)
+        first_max_entry[entry_vertices[max_entries][::-1]] = max_entries[::-1]
+        entry_bones = np.where(first_max_entry >= 0, vertex_weights.bone_indices[first_max_entry], -1).tolist()
+    bone_suffixes = [' weight %s 1' % bone_name_q for bone_name_q in vertex_weights.bone_names_q]
+    return ['' if bone_index < 0 else bone_suffixes[bone_index] for bone_index in entry_bones]
+
+def format_all_weights(vertex_weights):
+    """Return for each vertex the weight directives for all its non-zero weights, or '' if it has none"""
+    nonzero = vertex_weights.weights != 0
+    bone_names_q = vertex_weights.bone_names_q
+    entries = [' weight %s %.3f' % (bone_names_q[bone_index], weight)
+               for bone_index, weight in zip(vertex_weights.bone_indices[nonzero].tolist(),
+                                             vertex_weights.weights[nonzero].tolist())]
+    counts = np.bincount(vertex_weights.get_entry_vertices()[nonzero], minlength=len(vertex_weights.offsets) - 1)
+    offsets = np.concatenate(([0], np.cumsum(counts))).tolist()
+    return [','.join(entries[start:end]) for start, end in zip(offsets, offsets[1:])]
+
+def write_vertices(fw, positions, suffixes=None):
+    """Write v directives, suffixes (if not None) is a list of strings to append to each line (weights)"""
+    if suffixes is None:
+        write_rows(fw, 'v %.6f %.6f %.6f\n', positions)
+        return
+    for start in range(0, len(positions), FORMAT_CHUNK_ROWS):
+        chunk = positions[start:start+FORMAT_CHUNK_ROWS]
+        values = [None] * (len(chunk) * 4)
+        values[0::4] = chunk[:,0].tolist()
+        values[1::4] = chunk[:,1].tolist()
+        values[2::4] = chunk[:,2].tolist()
+        values[3::4] = suffixes[start:start+FORMAT_CHUNK_ROWS]
+        fw(('v %.6f %.6f %.6f%s\n' * len(chunk)) % tuple(values))
+
+def get_loop_triangles(mesh):
+    """
+    Return (triangle_loops, triangle_polygons) from the loop triangles (tessellation) of mesh (2.80+).
+    triangle_loops is a (triangle count, 3) int32 array of loop indices,
+    triangle_polygons the index of the polygon each triangle belongs to.
+    """
+    mesh.calc_loop_triangles()
+    count = len(mesh.loop_triangles)
+    triangle_loops = np.empty(count * 3, dtype=np.int32)
+    triangle_polygons = np.empty(count, dtype=np.int32)
+    mesh.loop_triangles.foreach_get('loops', triangle_loops)
+    mesh.loop_triangles.foreach_get('polygon_index', triangle_polygons)
+    return triangle_loops.reshape((count, 3)), triangle_polygons
+
+def get_polygon_faces(loop_starts, loop_totals, polygon_order):
+    """
+    Faces are the polygons, in polygon_order.
+    Return (face_polygons, corner_loops, face_sizes): the polygon index of each face,
+    the loop index of each corner of each face (concatenated), the corner count of each face.
+    """
+    polygon_order = np.asarray(polygon_order, dtype=np.int64)
+    return polygon_order, get_corner_loops(loop_starts, loop_totals, polygon_order), loop_totals[polygon_order]
+
+def get_triangle_faces(triangle_loops, triangle_polygons, polygon_order):
+    """
+    Faces are the loop triangles, following polygon_order (triangles of a same polygon are kept in order).
+    Return (face_polygons, corner_loops, face_sizes), see get_polygon_faces.
+    """
+    polygon_rank = np.empty(len(polygon_order), dtype=np.int64)
+    polygon_rank[polygon_order] = np.arange(len(polygon_order))
+    triangle_order = np.argsort(polygon_rank[triangle_polygons], kind='mergesort')
+    return (triangle_polygons[triangle_order].astype(np.int64),
+            triangle_loops[triangle_order].ravel().astype(np.int64),
+            np.full(len(triangle_order), 3, dtype=np.int32))
+
+def get_sort_order(*keys):
+    """
+    keys are arrays with one value per element, the first key being the most significant.
+    Return the (stable) permutation sorting the elements by keys.
+    """
+    # np.lexsort uses the last key as the primary key
+    return np.lexsort(tuple(reversed(keys)))
+
+class MeshData():
+    """
+    The v/vt/vn/vc data of an object, which doesn't depend on the index offsets.
+    uvs, normals and vertex_colors are the unique values (None if not exported).
+    """
+    def __init__(self, vertex_positions, vertex_weights, unique_weights, uvs, normals, vertex_colors):
+        self.vertex_positions = vertex_positions
+        self.vertex_weights = vertex_weights
+        self.unique_weights = unique_weights
+        self.uvs = uvs
+        self.normals = normals
+        self.vertex_colors = vertex_colors
+
+    def get_counts(self):
+        """Return the amount of (v, vt, vn, vc) directives, to update the total_* offsets with"""
+        return tuple(0 if data is None else len(data)
+                     for data in (self.vertex_positions, self.uvs, self.normals, self.vertex_colors))
+
+    def get_columns(self):
+        """Return (has uvs, has normals, has vertex colors), which index columns face corners have after v"""
+        return tuple(data is not None for data in (self.uvs, self.normals, self.vertex_colors))
+
+    def write(self, fw):
+        if self.vertex_weights is None:
+            write_vertices(fw, self.vertex_positions)
+        elif self.unique_weights:
+            write_vertices(fw, self.vertex_positions, format_unique_weights(self.vertex_weights))
+        else:
+            write_vertices(fw, self.vertex_positions, format_all_weights(self.vertex_weights))
+        if self.uvs is not None:
+            write_rows(fw, 'vt %.6f %.6f\n', self.uvs)
+        if self.normals is not None:
+            write_rows(fw, 'vn %.4f %.4f %.4f\n', self.normals)
+        if self.vertex_colors is not None:
+            write_rows(fw, 'vc %.3f %.3f %.3f %.3f\n', self.vertex_colors)
+
+    def format(self):
+        fragments = []
+        self.write(fragments.append)
+        return ''.join(fragments)
+
+class FormattedMeshData():
+    """MeshData already formatted (as read from the object cache), with the same interface"""
+    def __init__(self, text, counts, columns):
+        self.text = text
+        self.counts = counts
+        self.columns = columns
+
+    def get_counts(self):
+        return self.counts
+
+    def get_columns(self):
+        return self.columns
+
+    def write(self, fw):
+        fw(self.text)
+
+    def format(self):
+        return self.text
+
+class MeshBlock():
+    """
+    The directives of one object in .objex (g ... f), as extracted from Blender data by ObjexWriter.write_object.
+    It holds no bpy data so it can be pickled and formatted in another process (see format_mesh_block).
+    data is a MeshData or FormattedMeshData.
+    Indices in corner_indices are local to the object (0-based), the total_* offsets are applied when formatting.
+    runs is a list of (face start, face end, directives) with directives (usemtl, s) written before the faces of the run.
+    If cache_path is set, the formatted data and corner_indices are saved there for the object cache.
+    """
+    def __init__(self, header, data, corner_indices, face_sizes, runs, cache_path=None):
+        self.header = header
+        self.data = data
+        self.corner_indices = corner_indices
+        self.face_sizes = face_sizes
+        self.runs = runs
+        self.cache_path = cache_path
+
+    def get_counts(self):
+        return self.data.get_counts()
+
+def write_mesh_block(fw, block, offsets):
+    """
+    Write the text of block with fw, offsets being the (v, vt, vn, vc) index of the first directive of each kind in the block.
+    This is run in worker processes, it must not use bpy.
+    """
+    fw(block.header)
+    if block.cache_path is not None:
+        data_text = block.data.format()
+        export_objex_cache.save_entry(block.cache_path, data_text,
+            block.data.get_counts(), block.data.get_columns(), block.corner_indices)
+        fw(data_text)
+        del data_text
+    else:
+        block.data.write(fw)
+    # only offset the columns corner_indices has (v is always there)
+    columns = block.data.get_columns()
+    column_offsets = [offsets[0]] + [offset for offset, has_column in zip(offsets[1:], columns) if has_column]
+    corner_indices = block.corner_indices + np.array(column_offsets, dtype=np.int64)
+    corner_format = get_corner_format(*columns)
+    corner_offsets = np.concatenate(([0], np.cumsum(block.face_sizes))).tolist()
+    for run_start, run_end, directives in block.runs:
+        fw(directives)
+        write_faces(fw, corner_format,
+            corner_indices[corner_offsets[run_start]:corner_offsets[run_end]],
+            block.face_sizes[run_start:run_end])
+
+def format_mesh_block(block, offsets):
+    """Return the text of block, see write_mesh_block"""
+    fragments = []
+    write_mesh_block(fragments.append, block, offsets)
+    return ''.join(fragments)
+
+def format_mesh_block_timed(block, offsets):
+    """Return the text of block and the time formatting it took (in seconds), for tracing"""
+    start = time.perf_counter()
+    text = format_mesh_block(block, offsets)
+    return text, time.perf_counter() - start
+
+class MeshBlockWriter():
+    """
+    Format MeshBlock objects and write them with fw, in the order they are given.
+    With an executor (a process pool), blocks are formatted by worker processes while the caller
+    keeps extracting the next objects. At most max_pending blocks are kept waiting to be written.
+    Used as a context manager: on exit, remaining blocks are written (or dropped if an exception occurred)
+    and the executor is shut down.
+    A block can be given a before_write function, called right before its text is written.
+    """
+    def __init__(self, fw, executor=None, max_pending=1):
+        self.fw = fw
+        self.executor = executor
+        self.max_pending = max_pending
+        self._pending = collections.deque()
+
+    def write(self, block, offsets, before_write=None):
+        if self.executor is None:
+            if before_write:
+                before_write()
+            # written as it is formatted, without holding the text of the whole block
+            write_mesh_block(self.fw, block, offsets)
+            return
+        self._pending.append((self.executor.submit(format_mesh_block_timed, block, offsets), before_write))
+        while len(self._pending) > self.max_pending:
+            self._write_pending()
+
+    def _write_pending(self):
+        future, before_write = self._pending.popleft()
+        with tracing.span('wait for formatted block'):
+            text, format_time = future.result()
+        if before_write:
+            before_write()
+        # formatting happens in a worker process, which doesn't record spans
+        with tracing.span('write formatted block', size=len(text), format_ms=format_time * 1000):
+            self.fw(text)
+
+    def finish(self):
+        """Write all blocks still being formatted"""
+        while self._pending:
+            self._write_pending()
+
+    def cancel(self):
+        """Drop blocks still being formatted (used when the export is aborted)"""
+        for future, before_write in self._pending:
+            future.cancel()
+        self._pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.finish()
+            else:
+                self.cancel()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
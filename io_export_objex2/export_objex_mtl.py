@@ -368,7 +368,13 @@ class ObjexMaterialNodeTreeExplorer():
             return {'type':'normals'}
 
 # fixme this is going to end up finding uv/vcolor layers from node (or default to active I guess), if several layers, may write the wrong layer in .objex ... should call write_mtl and get uvs/vcolor data this way before writing the .objex?
-def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
+def write_mtl_incremental(scene, filepath, append_header, options, copy_set, open_output, index=None):
+    """
+    Generator writing the .mtlex as materials are found, so it is written along the .objex
+    Once started with next(), send it (name, name_q, material, face_img) tuples (the values of mtl_dict) for each
+    new material, then finish it with finish_mtl_incremental.
+    index: an ExportIndex (see export_objex_index) to add the newtex/newmtl records to, or None
+    """
     log = getLogger('export_objex_mtl')
 
     source_dir = os.path.dirname(bpy.data.filepath)
@@ -379,20 +385,26 @@ def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
 
     warned_about_image_color_space = set()
 
-    with open(filepath, "w", encoding="utf8", newline="\n") as f:
+    with open_output(filepath) as f:
         fw = f.write
+        if index:
+            index_record = index.get_recorder(f)
+        else:
+            def index_record(directive, name):
+                pass
 
         fw('# Blender MTL File: %r\n' % (os.path.basename(bpy.data.filepath) or "None"))
-        fw('# Material Count: %i\n' % len(mtl_dict))
 
-        # used for writing exportid
-        append_header(fw)
+        # used for writing exportid, given the OutputSink
+        append_header(f)
 
         # maps an image to (texture_name, texture_name_q),
         # to avoid duplicate newtex declarations
         # does not prevent duplicate file paths because different images
         # (with same file path) may have different properties set
         declared_textures = {}
+        # names used in declared_textures
+        texture_names = util.UniqueNames('%s_%d')
 
         def getImagePath(image, filename=None):
             image_filepath = image.filepath
@@ -416,16 +428,13 @@ def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
                 texture_name, texture_name_q = data
                 log.trace('Skipped writing texture {} {}', texture_name, image)
             else:
-                texture_name = image.name
                 # make sure texture_name is not already used
-                i = 0
-                while texture_name in (_texture_name for _texture_name, _texture_name_q in declared_textures.values()):
-                    i += 1
-                    texture_name = '%s_%d' % (name, i)
-                if i != 0:
-                    log.debug('Texture name {} was already used, using {} instead', name, texture_name)
+                texture_name = texture_names.allocate(image.name)
+                if texture_name != image.name:
+                    log.debug('Texture name {} was already used, using {} instead', image.name, texture_name)
                 texture_name_q = util.quote(texture_name)
                 declared_textures[image] = (texture_name, texture_name_q)
+                index_record('newtex', texture_name)
                 fw('newtex %s\n' % texture_name_q)
                 filepath = getImagePath(image, texture_name)
                 fw('map %s\n' % filepath)
@@ -460,8 +469,15 @@ def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
             # the name used for writing the image path (quoted)
             return texture_name_q
 
+        material_count = 0
+
         # mind the continue used in this loop to skip writing most stuff for collision / empty materials
-        for name, name_q, material, face_img in mtl_dict.values():
+        while True:
+            entry = yield
+            if entry is None:
+                break
+            name, name_q, material, face_img = entry
+            material_count += 1
             log.trace('Writing name={!r} name_q={!r} material={!r} face_img={!r}', name, name_q, material, face_img)
             util.detect_zztag(log, name)
             objex_data = material.objex_bonus if material else None
@@ -478,6 +494,7 @@ def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
                 # checking if the prefix "collision." on the object name is consistent with
                 # objex_data.use_collision is done in ObjexWriter#write_object in export_objex.py
                 if objex_data.use_collision:
+                    index_record('newmtl', name)
                     fw('newmtl %s\n' % name_q)
                     write_collision_material(fw, objex_data.collision)
                     continue
@@ -486,6 +503,7 @@ def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
                 # 421todo attrib, collision/colliders
                 # zzconvert detects "empty." on its own, making it explicit here doesn't hurt
                 if objex_data.empty or name.startswith('empty.'):
+                    index_record('newmtl', name)
                     fw('newmtl %s\n' % name_q)
                     fw('empty\n')
                     if objex_data.branch_to_object: # branch_to_object is a MESH object
@@ -545,6 +563,7 @@ def write_mtl(scene, filepath, append_header, options, copy_set, mtl_dict):
                             )
                         texelData['texture_name_q'] = writeTexture(image)
                 # write newmtl after any newtex block
+                index_record('newmtl', name)
                 fw('newmtl %s\n' % name_q)
                 if 'shade' in data:
                     shadingType = data['shade']['type']
@@ -857,10 +876,24 @@ count  P              A              M              B            comment
                     texture_name_q = writeTexture(image)
                 else:
                     texture_name_q = None
+                index_record('newmtl', name)
                 fw('newmtl %s\n' % name_q)
                 if texture_name_q:
                     fw('texel0 %s\n' % texture_name_q)
 
+        # materials are written as they are found, so the count is only known at the end
+        # (the comment isn't part of the last newmtl record)
+        if index:
+            index.end_records(f)
+        fw('# Material Count: %i\n' % material_count)
+
+def finish_mtl_incremental(mtl_writer):
+    """Write the end of the .mtlex and close it, see write_mtl_incremental"""
+    try:
+        mtl_writer.send(None)
+    except StopIteration:
+        pass
+
 def write_collision_material(fw, collision):
     if collision.ignore_camera:
         fw('attrib collision.IGNORE_CAMERA\n')
@@ -0,0 +1,162 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Statistics of an export (per object, per action and per output file), for finding what is expensive to export
+and checking the effect of changes to the exporter
+"""
+
+import collections
+import json
+import os
+
+
+def get_stats_path(filepath):
+    """Return the path of the statistics written when exporting to filepath, next to it"""
+    return os.path.splitext(filepath)[0] + '_stats.json'
+
+class DirectiveCounter():
+    """
+    Output sink observer counting the lines and bytes of each directive (first word of lines) in a text file
+    Chunks don't have to end at a line end, the last line of a chunk is counted with the next chunk
+    """
+    def __init__(self):
+        self.lines = collections.Counter()
+        self.bytes = collections.Counter()
+        self._partial_line = b''
+
+    def __call__(self, chunk):
+        lines = (self._partial_line + chunk).split(b'\n')
+        self._partial_line = lines.pop()
+        self.count_lines(lines)
+
+    def count_lines(self, lines):
+        line_counts = self.lines
+        byte_counts = self.bytes
+        for line in lines:
+            directive = line.partition(b' ')[0]
+            line_counts[directive] += 1
+            byte_counts[directive] += len(line) + 1
+
+    def get_stats(self):
+        """Return {directive: {'lines': line count, 'bytes': byte count}}"""
+        if self._partial_line:
+            # the file doesn't end with a line end
+            self.count_lines([self._partial_line])
+            self._partial_line = b''
+        return {
+            directive.decode('utf8', 'replace'): {'lines': self.lines[directive], 'bytes': self.bytes[directive]}
+            for directive in sorted(self.bytes, key=self.bytes.get, reverse=True)
+        }
+
+class ExportStats():
+    def __init__(self):
+        self.objects = []
+        self.actions = []
+        # {filepath: DirectiveCounter}
+        self.directive_counters = {}
+
+    def get_directive_counter(self, filepath):
+        """Return a DirectiveCounter for the text file at filepath, to add as an observer of its OutputSink"""
+        counter = self.directive_counters[filepath] = DirectiveCounter()
+        return counter
+
+    def add_object(self, name, vertices, faces, corners, unique_uvs, unique_normals, unique_vertex_colors,
+                   material_switches, cached):
+        """
+        Add the statistics of an object block
+        unique_*: amount of vt/vn/vc written, or None if not exported, to compare with the amount of face corners
+        material_switches: amount of usemtl/clearmtl directives
+        """
+        self.objects.append({
+            'name': name,
+            'vertices': vertices,
+            'faces': faces,
+            'corners': corners,
+            'unique_uvs': unique_uvs,
+            'unique_normals': unique_normals,
+            'unique_vertex_colors': unique_vertex_colors,
+            'material_switches': material_switches,
+            'cached': cached,
+        })
+
+    def add_action(self, armature, action, frames, bones):
+        self.actions.append({
+            'armature': armature,
+            'action': action,
+            'frames': frames,
+            'bones': bones,
+        })
+
+    def get_totals(self):
+        totals = {
+            key: sum(ob[key] for ob in self.objects)
+            for key in ('vertices', 'faces', 'corners', 'material_switches')
+        }
+        for key in ('unique_uvs', 'unique_normals', 'unique_vertex_colors'):
+            exported = [ob for ob in self.objects if ob[key] is not None]
+            unique = sum(ob[key] for ob in exported)
+            corners = sum(ob['corners'] for ob in exported)
+            totals[key] = unique
+            # ratio of unique values to values before deduplication (one per face corner)
+            totals[key + '_ratio'] = unique / corners if corners else None
+        totals['objects'] = len(self.objects)
+        totals['actions'] = len(self.actions)
+        totals['frames'] = sum(action['frames'] for action in self.actions)
+        return totals
+
+    def get_file_stats(self, outputs):
+        """outputs: OutputSink objects of the exported files"""
+        files = []
+        for output in outputs:
+            counter = self.directive_counters.get(output.filepath)
+            files.append({
+                'path': output.filepath,
+                'bytes': output.bytes_written,
+                'directives': counter.get_stats() if counter else None,
+            })
+        return files
+
+    def write(self, sink, outputs):
+        """Write the statistics to sink, a binary OutputSink (not in outputs)"""
+        sink.write(json.dumps({
+            'totals': self.get_totals(),
+            'files': self.get_file_stats(outputs),
+            'objects': self.objects,
+            'actions': self.actions,
+        }, indent=1).encode('utf8'))
+
+    def get_summary(self, outputs, directive_count=5):
+        """Return a short text summary, with the directive_count directives taking the most bytes in each file"""
+        totals = self.get_totals()
+        lines = [
+            '{objects:d} objects: {vertices:d} vertices, {faces:d} faces, {corners:d} face corners, '
+            '{material_switches:d} material switches'.format(**totals)
+        ]
+        for key, directive in (('unique_uvs', 'vt'), ('unique_normals', 'vn'), ('unique_vertex_colors', 'vc')):
+            if totals[key + '_ratio'] is not None:
+                lines.append('{}: {:d} written, {:.1%} of the face corners using them'
+                             .format(directive, totals[key], totals[key + '_ratio']))
+        if self.actions:
+            lines.append('{actions:d} actions, {frames:d} frames'.format(**totals))
+        for file_stats in self.get_file_stats(outputs):
+            directives = file_stats['directives']
+            if not directives or not file_stats['bytes']:
+                continue
+            lines.append('{}: {}'.format(os.path.basename(file_stats['path']), ', '.join(
+                '{} {:.1%}'.format(directive, directive_stats['bytes'] / file_stats['bytes'])
+                for directive, directive_stats in list(directives.items())[:directive_count]
+            )))
+        return '\n'.join(lines)
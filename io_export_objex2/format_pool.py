@@ -0,0 +1,78 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Pool of worker processes formatting objects (see export_objex_mesh.MeshBlockWriter)
+
+Workers are spawned, not forked: Blender is multi-threaded, and a forked child would inherit its whole state
+(including locks held by other threads). Spawned workers only import the bpy-free modules
+export_objex_mesh and export_objex_cache, but the addon package can't be imported in them as-is
+(its __init__ needs bpy). So workers run this file as their main module (instead of the one of Blender,
+which may be a script being run), which registers the package without running its __init__.
+
+This module must not use bpy or relative imports.
+"""
+
+import concurrent.futures
+import multiprocessing.context
+import os
+import sys
+import types
+
+# environment variable holding the addon package name, inherited by workers
+PACKAGE_ENV = 'IO_EXPORT_OBJEX2_PACKAGE'
+
+
+class WorkerProcess(multiprocessing.context.SpawnProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        # the worker runs the file of the parent __main__ module before anything else
+        main_module = sys.modules['__main__']
+        worker_main_module = types.ModuleType('__main__')
+        worker_main_module.__file__ = os.path.abspath(__file__)
+        sys.modules['__main__'] = worker_main_module
+        try:
+            return multiprocessing.context.SpawnProcess._Popen(process_obj)
+        finally:
+            sys.modules['__main__'] = main_module
+
+class WorkerContext(multiprocessing.context.SpawnContext):
+    Process = WorkerProcess
+
+def create_pool(processes, package_name, python_executable=None):
+    """
+    Return a ProcessPoolExecutor of processes workers, able to run functions of package_name (the addon package)
+    modules which don't use bpy
+    python_executable: the Python interpreter to run workers with, if not sys.executable
+    """
+    os.environ[PACKAGE_ENV] = package_name
+    context = WorkerContext()
+    if python_executable is not None:
+        context.set_executable(python_executable)
+    return concurrent.futures.ProcessPoolExecutor(processes, mp_context=context)
+
+def register_package(package_name, package_path):
+    """Register package_name (and its parent packages) at package_path, without running any __init__"""
+    parts = package_name.split('.')
+    for i in range(1, len(parts) + 1):
+        name = '.'.join(parts[:i])
+        if name in sys.modules:
+            continue
+        package = types.ModuleType(name)
+        package.__path__ = [package_path] if i == len(parts) else []
+        sys.modules[name] = package
+
+if __name__ == '__mp_main__': # in a worker
+    register_package(os.environ[PACKAGE_ENV], os.path.dirname(os.path.abspath(__file__)))
@@ -0,0 +1,115 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Binary objex container (.objexbin) format definition and reader
+
+Layout, all little-endian:
+- header: magic, format version, reserved u32
+- sections: arrays of fixed-size items, each starting at a multiple of ALIGNMENT
+- table: utf8 JSON {"sections": {name: {"offset", "format", "shape"}}, "meta": {...}}
+  with format a struct/memoryview format character (see FORMATS)
+- footer: u64 table offset, u64 table size
+
+meta describes the content ("objects", "materials", "skeletons", "animations", see export_objex_binary.ContainerWriter)
+and refers to sections by name.
+
+Sections are viewed in place, in native byte order, so ContainerReader only works on little-endian machines
+(all platforms Blender runs on).
+
+This module only uses the standard library (no bpy, no numpy, no relative imports),
+so tools can use it outside of Blender by loading this file directly.
+"""
+
+import json
+import mmap
+import struct
+import sys
+
+MAGIC = b'OBJEXBIN'
+VERSION = 1
+ALIGNMENT = 16
+HEADER = struct.Struct('<8sII')
+FOOTER = struct.Struct('<QQ')
+# format character: item size
+FORMATS = {
+    'i': 4,
+    'f': 4,
+}
+
+
+class ContainerReader():
+    """
+    Read a .objexbin file, sections are exposed as (multi-dimensional) memoryviews of the memory-mapped file
+    The file stays mapped until the reader is closed and all views are released (see memoryview.release)
+    """
+    def __init__(self, filepath):
+        if sys.byteorder != 'little':
+            raise ValueError('Sections can only be viewed in place on little-endian machines')
+        self._file = open(filepath, 'rb')
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except:
+            self._file.close()
+            raise
+        try:
+            self._read_table()
+        except:
+            self.close()
+            raise
+
+    def _read_table(self):
+        magic, version, _ = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            raise ValueError('Not an objex binary container (magic %r)' % magic)
+        if version != VERSION:
+            raise ValueError('Unsupported objex binary container version %d (expected %d)' % (version, VERSION))
+        table_offset, table_size = FOOTER.unpack_from(self._mmap, len(self._mmap) - FOOTER.size)
+        table = json.loads(self._mmap[table_offset:table_offset + table_size].decode('utf8'))
+        self.sections = table['sections']
+        self.meta = table['meta']
+
+    def get_section(self, name):
+        """
+        Return a read-only memoryview of section name, with the section format and shape
+        (empty sections are one-dimensional, memoryview can't have a shape with zeros)
+        """
+        section = self.sections[name]
+        item_size = FORMATS[section['format']]
+        shape = section['shape']
+        size = item_size
+        for dimension in shape:
+            size *= dimension
+        offset = section['offset']
+        view = memoryview(self._mmap)[offset:offset + size]
+        if size == 0:
+            return view.cast(section['format'])
+        return view.cast(section['format'], shape)
+
+    def close(self):
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # views are still in use, the mapping is released along with the last of them
+                pass
+            self._mmap = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,389 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+import gzip
+import hashlib
+import os
+import queue
+import threading
+
+from . import tracing
+
+# flush pending fragments once they amount to this many bytes (utf8-encoded, for text sinks)
+DEFAULT_CHUNK_SIZE = 1 << 20
+# how many chunks may wait to be written by a BackgroundWriter before write() blocks
+DEFAULT_MAX_QUEUED_CHUNKS = 16
+# compression: file extension
+COMPRESSION_EXTENSIONS = {
+    'GZIP': '.gz',
+    'XZ': '.xz',
+}
+# zlib's default, much faster than gzip's default 9 for a slightly larger file
+GZIP_COMPRESS_LEVEL = 6
+
+if hasattr(str, 'isascii'): # Python 3.7+
+    def get_utf8_size(text):
+        """Return the size of text once encoded as utf8, without encoding it if it is ascii (most text)"""
+        return len(text) if text.isascii() else len(text.encode('utf8'))
+else:
+    def get_utf8_size(text):
+        return len(text.encode('utf8'))
+
+class BackgroundWriter():
+    """
+    Thread doing the file writes (and running the observers) of the OutputSink objects using it,
+    so the main thread keeps formatting while chunks are written to disk.
+    Tasks run in the order they are submitted. The thread is started on the first task.
+    An exception in a task is raised again in the main thread on the next submit/wait.
+    """
+    def __init__(self, max_queued=DEFAULT_MAX_QUEUED_CHUNKS):
+        self._queue = queue.Queue(max_queued)
+        self._thread = None
+        self._error = None
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            try:
+                if task is None:
+                    return
+                function, args, cleanup = task
+                # skip everything but clean-up after an error, the export is going to be aborted
+                if self._error is None or cleanup:
+                    try:
+                        function(*args)
+                    except BaseException as e:
+                        if self._error is None:
+                            self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _check(self):
+        if self._error is not None:
+            error = self._error
+            self._error = None
+            raise error
+
+    def _put(self, task):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='objex output writer', daemon=True)
+            self._thread.start()
+        self._queue.put(task)
+
+    def submit(self, function, *args):
+        self._check()
+        self._put((function, args, False))
+
+    def submit_cleanup(self, function, *args):
+        """Submit a task that runs even after a task failed (like closing files)"""
+        self._put((function, args, True))
+
+    def wait(self):
+        """Wait for all submitted tasks to be done"""
+        if self._thread is not None:
+            self._queue.join()
+        self._check()
+
+    def close(self):
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        self._check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't hide the exception with a (likely consequent) error from the thread
+            try:
+                self.close()
+            except BaseException:
+                pass
+
+class OutputSink():
+    """
+    Output file used by all the writers (.objex, .mtlex, .skel, .anim, Link animation .bin).
+    Written fragments are accumulated and written to the file in large chunks.
+    Text is encoded as utf8, with '\\n' line endings (the fragments are written as-is).
+    Observers can be attached to see every chunk (as bytes) right before it is written.
+    With a BackgroundWriter, chunks are written (and observers called) by its thread.
+    With compression (a key of COMPRESSION_EXTENSIONS), chunks are compressed as they are written,
+    bytes_written, tell() and observers are about the uncompressed data.
+    With atomic, the file is written to a temporary file next to filepath and only replaces filepath
+    when commit() is called after closing, and if the content differs (see changed).
+    With patchable, placeholders written with write_placeholder can be replaced after closing (see fill_placeholders),
+    compressed files are then written uncompressed to a staging file and only compressed once filled.
+    """
+    def __init__(self, filepath, binary=False, chunk_size=DEFAULT_CHUNK_SIZE, background=None, compression=None, atomic=False,
+                 patchable=False):
+        self.filepath = filepath
+        self.binary = binary
+        self.chunk_size = chunk_size
+        self.background = background
+        self.compression = compression
+        self.atomic = atomic
+        self.patchable = patchable
+        # (offset, placeholder) of each placeholder written
+        self.placeholders = []
+        # after commit(), if filepath was written to (False if it already had the same content)
+        self.changed = None
+        self.bytes_written = 0
+        self.observers = []
+        self._pending = []
+        self._pending_size = 0
+        self._temp_path = '%s.%d.tmp' % (filepath, os.getpid()) if atomic else None
+        self._staging_path = '%s.%d.staging' % (filepath, os.getpid()) if patchable and compression else None
+        # files to close in order, the first one is written to
+        if self._staging_path:
+            self._files = open_files(self._staging_path)
+        else:
+            # patched files are hashed again when committing
+            self._files = open_files(self._temp_path if atomic else filepath, compression,
+                                     hash_written=atomic and not patchable)
+        self._file = self._files[0]
+
+    def add_observer(self, observer):
+        """observer is called with each chunk (bytes) written to the file"""
+        self.observers.append(observer)
+
+    def write(self, data):
+        self._pending.append(data)
+        # in bytes, so tell() doesn't need to flush
+        self._pending_size += len(data) if self.binary else get_utf8_size(data)
+        if self._pending_size >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._pending:
+            return
+        if self.binary:
+            chunk = b''.join(self._pending)
+        else:
+            chunk = ''.join(self._pending).encode('utf8')
+        self._pending = []
+        self._pending_size = 0
+        self.bytes_written += len(chunk)
+        if self.background is not None:
+            self.background.submit(self._write_chunk, self._file, chunk)
+        else:
+            self._write_chunk(self._file, chunk)
+
+    def _write_chunk(self, file, chunk):
+        with tracing.span('write chunk', file=self.filepath, size=len(chunk)):
+            for observer in self.observers:
+                observer(chunk)
+            file.write(chunk)
+
+    def tell(self):
+        """Return the amount of bytes written so far, including pending fragments (which are not flushed)"""
+        return self.bytes_written + self._pending_size
+
+    def sync(self):
+        """Flush and wait for all chunks to be written (and observers to be called)"""
+        self.flush()
+        if self.background is not None:
+            self.background.wait()
+
+    def write_placeholder(self, text):
+        """Write text (bytes in a binary sink) to be replaced later by fill_placeholders"""
+        if not self.patchable:
+            raise ValueError('Placeholders can only be written to a patchable OutputSink')
+        self.placeholders.append((self.tell(), text))
+        self.write(text)
+
+    def fill_placeholders(self, values):
+        """
+        Replace each placeholder written with write_placeholder by values[placeholder],
+        of the same length once encoded, in the closed file (and compress it with compression)
+        """
+        if self._file is not None:
+            raise ValueError('Placeholders can only be filled once the OutputSink is closed')
+        with tracing.span('fill placeholders', file=self.filepath):
+            path = self._staging_path or self._temp_path or self.filepath
+            with open(path, 'r+b') as f:
+                for offset, placeholder in self.placeholders:
+                    value = values[placeholder]
+                    if not self.binary:
+                        placeholder = placeholder.encode('utf8')
+                        value = value.encode('utf8')
+                    if len(value) != len(placeholder):
+                        raise ValueError('Placeholder %r and its value %r differ in length' % (placeholder, value))
+                    f.seek(offset)
+                    f.write(value)
+            if self._staging_path:
+                files = open_files(self._temp_path or self.filepath, self.compression, hash_written=self.atomic)
+                try:
+                    with open(path, 'rb') as staging_file:
+                        while True:
+                            block = staging_file.read(self.chunk_size)
+                            if not block:
+                                break
+                            files[0].write(block)
+                finally:
+                    close_files(files)
+                self._files = files
+                self._staging_path = None
+                os.remove(path)
+
+    def close(self):
+        if self._file is None:
+            return
+        try:
+            self.flush()
+        finally:
+            if self.background is not None:
+                # the file is closed once all its chunks are written
+                self.background.submit_cleanup(close_files, self._files)
+                self._file = None
+                self.background.wait()
+            else:
+                self._file = None
+                close_files(self._files)
+
+    def get_file_size(self):
+        """Return the size of the written (closed) file, which differs from bytes_written with compression"""
+        hashing_file = self._files[-1]
+        if isinstance(hashing_file, HashingFile):
+            return hashing_file.size
+        return os.path.getsize(self._temp_path or self.filepath)
+
+    def commit(self):
+        """
+        With atomic, move the (closed) temporary file to filepath, unless filepath has the same content,
+        does nothing if already committed or discarded
+        """
+        if not self.atomic:
+            self.changed = True
+            return
+        if self._temp_path is None:
+            return
+        size = self.get_file_size()
+        temp_path = self._temp_path
+        self._temp_path = None
+        hashing_file = self._files[-1]
+        if (os.path.isfile(self.filepath)
+            and os.path.getsize(self.filepath) == size
+            and get_file_digest(self.filepath) == (hashing_file.hasher.digest()
+                if isinstance(hashing_file, HashingFile) else get_file_digest(temp_path))
+        ):
+            os.remove(temp_path)
+            self.changed = False
+        else:
+            os.replace(temp_path, self.filepath)
+            self.changed = True
+
+    def discard(self):
+        """Close and remove the temporary and staging files (with atomic, leaving filepath as it was)"""
+        if self._temp_path is None and self._staging_path is None:
+            return
+        try:
+            self.close()
+        finally:
+            for path in (self._temp_path, self._staging_path):
+                if path is not None and os.path.exists(path):
+                    os.remove(path)
+            self._temp_path = None
+            self._staging_path = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class AtomicOutputs():
+    """
+    Context manager committing the OutputSink objects in sinks (closed by then) when exiting normally,
+    or discarding them when exiting because of an exception
+    """
+    def __init__(self):
+        self.sinks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            for sink in self.sinks:
+                sink.commit()
+        else:
+            for sink in self.sinks:
+                try:
+                    sink.discard()
+                except Exception:
+                    # don't hide the original exception
+                    pass
+
+class HashingFile():
+    """Binary file wrapper hashing and counting the bytes written to it"""
+    def __init__(self, file):
+        self.file = file
+        self.hasher = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hasher.update(data)
+        self.size += len(data)
+        return self.file.write(data)
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+def get_file_digest(filepath, block_size=DEFAULT_CHUNK_SIZE):
+    """Return the sha1 digest of the content of filepath, like HashingFile.hasher"""
+    hasher = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return hasher.digest()
+            hasher.update(block)
+
+def open_files(filepath, compression=None, hash_written=False):
+    """
+    Open filepath for writing, return the files to close in order (see close_files), the first one is written to
+    With hash_written, the last file is a HashingFile of what is written to filepath
+    """
+    raw_file = open(filepath, 'wb')
+    try:
+        if hash_written:
+            raw_file = HashingFile(raw_file)
+        if compression is None:
+            return [raw_file]
+        if compression == 'GZIP':
+            # no file name and mtime in the header, so identical data gives an identical file
+            return [gzip.GzipFile(filename='', mode='wb', compresslevel=GZIP_COMPRESS_LEVEL, fileobj=raw_file, mtime=0), raw_file]
+        if compression == 'XZ':
+            import lzma # may not be available in some Python builds
+            return [lzma.LZMAFile(raw_file, 'wb'), raw_file]
+        raise ValueError('Unknown compression %r' % compression)
+    except:
+        raw_file.close()
+        raise
+
+def close_files(files):
+    """Close all files in order, even if closing one fails"""
+    try:
+        files[0].close()
+    finally:
+        if len(files) > 1:
+            close_files(files[1:])
@@ -0,0 +1,146 @@
+#  Copyright 2021 io_export_objex2 contributors
+#
+#  This objex2 addon is free software: you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation, either version 3 of the License, or
+#  (at your option) any later version.
+#
+#  This objex2 addon is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this objex2 addon.  If not, see <https://www.gnu.org/licenses/>.
+
+"""
+Opt-in timeline of export steps, written in the Chrome trace event format
+(open with chrome://tracing or https://ui.perfetto.dev)
+
+Steps are recorded with span() from anywhere (any thread) while a Recording is active,
+and span() is (almost) free when no Recording is active.
+"""
+
+import json
+import os
+import threading
+import time
+
+# the active Recording, or None
+_recording = None
+
+
+class Span():
+    """
+    A step being timed, ends when leaving the with block or when end() is called
+    (for steps that can't be wrapped in a with block)
+    """
+    def __init__(self, recording, name, args):
+        self.recording = recording
+        self.name = name
+        self.args = args
+        self.start = time.perf_counter()
+
+    def end(self):
+        self.recording.add_span(self.name, self.start, time.perf_counter(), self.args)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.end()
+
+class NullSpan():
+    """Span used when not recording"""
+    def end(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+_null_span = NullSpan()
+
+def span(name, **args):
+    """Return a Span timing a step named name, args (shown with the step) must be JSON-serializable"""
+    recording = _recording
+    if recording is None:
+        return _null_span
+    return Span(recording, name, args)
+
+def get_trace_path(filepath):
+    """Return the path of the trace written when exporting to filepath, next to it"""
+    return os.path.splitext(filepath)[0] + '_trace.json'
+
+
+class Recording():
+    """
+    Context manager recording spans while active and writing them to filepath when exiting
+    Does nothing if filepath is None
+    """
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.events = []
+        self.thread_names = {}
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+
+    def add_span(self, name, start, end, args):
+        thread = threading.current_thread()
+        # only the first span of a thread adds to thread_names, and dict/list operations are atomic
+        if thread.ident not in self.thread_names:
+            self.thread_names[thread.ident] = thread.name
+        event = {
+            'name': name,
+            'ph': 'X', # complete event
+            'ts': (start - self.origin) * 1e6, # microseconds
+            'dur': (end - start) * 1e6,
+            'pid': self.pid,
+            'tid': thread.ident,
+        }
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def write(self):
+        events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': thread_name}}
+            for tid, thread_name in self.thread_names.items()
+        ]
+        events.extend(self.events)
+        # written to a temporary file replacing filepath once complete, like exported files with ATOMIC_WRITE
+        # (the recording outlives the AtomicOutputs of the export, so it commits its own output)
+        from . import output_sink # imports this module
+        sink = output_sink.OutputSink(self.filepath, atomic=True)
+        try:
+            with sink:
+                sink.write(json.dumps({'traceEvents': events, 'displayTimeUnit': 'ms'}))
+            sink.commit()
+        except:
+            sink.discard()
+            raise
+
+    def __enter__(self):
+        global _recording
+        if self.filepath is not None:
+            if _recording is not None:
+                raise RuntimeError('Already recording to %s' % _recording.filepath)
+            _recording = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        global _recording
+        if self.filepath is not None:
+            _recording = None
+            # also write the trace of a failed export, it shows how far the export got
+            if exc_type is None:
+                self.write()
+            else:
+                # don't hide the exception with an error writing the trace
+                try:
+                    self.write()
+                except Exception:
+                    from .logging_util import getLogger # needs bpy
+                    getLogger('tracing').exception('Could not write the trace to {}', self.filepath)
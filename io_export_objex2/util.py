@@ -16,6 +16,8 @@
 import bpy
 
 import json
+import os
+import sys
 
 from . import blender_version_compatibility
 
@@ -26,6 +28,31 @@ class ObjexExportAbort(Exception):
     def __init__(self, reason):
         self.reason = reason
 
+class UniqueNames():
+    """
+    Allocates unique names.
+    A name already in use is made unique by formatting it with a number, using suffix_format
+    (for example '%s %d' makes 'name 1', 'name 2'...).
+    Keeps the set of used names and, for each base name, the next number to try,
+    so allocating many names with the same base does not get slower and slower.
+    """
+    def __init__(self, suffix_format):
+        self.suffix_format = suffix_format
+        self.used = set()
+        self.next_suffix = {}
+
+    def allocate(self, name_base):
+        name = name_base
+        if name in self.used:
+            i = self.next_suffix.get(name_base, 1)
+            name = self.suffix_format % (name_base, i)
+            while name in self.used:
+                i += 1
+                name = self.suffix_format % (name_base, i)
+            self.next_suffix[name_base] = i + 1
+        self.used.add(name)
+        return name
+
 def detect_zztag(log, name):
     if (name[0:2] == 'ZZ'
         or any(suspicious_string in name for suspicious_string in ('_ZZ', '#ZZ', '|ZZ'))
@@ -42,3 +69,88 @@ def get_addon_preferences():
         return addons_preferences[__package__].preferences
     else:
         return None
+
+def _get_process_memory_counters_windows():
+    import ctypes
+    import ctypes.wintypes
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [
+            ('cb', ctypes.wintypes.DWORD),
+            ('PageFaultCount', ctypes.wintypes.DWORD),
+            ('PeakWorkingSetSize', ctypes.c_size_t),
+            ('WorkingSetSize', ctypes.c_size_t),
+            ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+            ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+            ('PagefileUsage', ctypes.c_size_t),
+            ('PeakPagefileUsage', ctypes.c_size_t),
+        ]
+    get_current_process = ctypes.windll.kernel32.GetCurrentProcess
+    get_current_process.restype = ctypes.wintypes.HANDLE
+    get_process_memory_info = ctypes.WinDLL('psapi').GetProcessMemoryInfo
+    get_process_memory_info.argtypes = (ctypes.wintypes.HANDLE, ctypes.c_void_p, ctypes.wintypes.DWORD)
+    counters = PROCESS_MEMORY_COUNTERS()
+    counters.cb = ctypes.sizeof(counters)
+    if not get_process_memory_info(get_current_process(), ctypes.byref(counters), counters.cb):
+        return None
+    return counters
+
+def get_peak_rss():
+    """
+    Return the peak resident set size (the most memory used at once so far) of the Blender process, in bytes,
+    or None if it can't be measured on this platform
+    """
+    try:
+        import resource
+    except ImportError: # Windows
+        try:
+            counters = _get_process_memory_counters_windows()
+        except (AttributeError, OSError):
+            return None
+        return counters.PeakWorkingSetSize if counters else None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def get_current_rss():
+    """
+    Return the current resident set size of the Blender process, in bytes,
+    or None if it can't be measured on this platform (only Linux and Windows)
+    """
+    if sys.platform == 'win32':
+        try:
+            counters = _get_process_memory_counters_windows()
+        except (AttributeError, OSError):
+            return None
+        return counters.WorkingSetSize if counters else None
+    try:
+        with open('/proc/self/statm') as f:
+            # in pages: total program size, resident set size, ...
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+def reset_peak_rss():
+    """
+    Reset the peak resident set size of the Blender process (as read by get_peak_rss_since_reset),
+    return False if it can't be reset on this platform (only Linux 4.0+)
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return False
+    return True
+
+def get_peak_rss_since_reset():
+    """Return the peak resident set size of the Blender process since reset_peak_rss, in bytes, or None"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    # in kB
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None